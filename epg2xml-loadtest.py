@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""epg2xml 부하 테스트
+
+epg2xml-sim.py 시뮬레이터를 띄우고 가상 채널 N개, 기간 D일로 epg2xml.py를
+처음부터 끝까지 실행해서 걸린 시간과 초당 요청 수를 표로 출력한다.
+epg2xml.py는 임시 디렉토리에 복사해서 실행하므로 Channel_*.json 등은 건드리지 않는다.
+
+    python3 epg2xml-loadtest.py --channels 100,500,2000 --days 1,3,7
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import importlib.util
+
+__dirpath__ = os.path.dirname(os.path.realpath(sys.argv[0]))
+
+
+def load_sim():
+    spec = importlib.util.spec_from_file_location('epg2xml_sim', os.path.join(__dirpath__, 'epg2xml-sim.py'))
+    sim = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(sim)
+    return sim
+
+
+def int_list(value):
+    return [int(x) for x in value.split(',') if x.strip()]
+
+
+def run_once(sim, script, workdir, channels, days, args):
+    channelfile = os.path.join(workdir, 'Channel.json')
+    configfile = os.path.join(workdir, 'epg2xml.json')
+    xmlfile = os.path.join(workdir, 'xmltv.xml')
+    chans = sim.synthetic_channels(channels)
+    with open(channelfile, 'w', encoding='utf-8') as f:
+        json.dump(chans, f, ensure_ascii=False)
+    with open(configfile, 'w', encoding='utf-8') as f:
+        json.dump({
+            'MyISP': 'ALL',
+            'MyChannels': '*',
+            'output': 'o',
+            'default_xml_file': xmlfile,
+            'default_fetch_limit': str(days),
+            'default_verbose': 'y',
+            'default_dead_days': '0',
+        }, f)
+
+    server = sim.start_server(chans, programs=args.programs, latency=args.latency, error_rate=args.error_rate, seed=args.seed,
+                              stall_rate=args.stall_rate, stall=args.stall)
+    cmd = [sys.executable, script, '--config', configfile, '--channelfile', channelfile,
+           '--logfile', os.path.join(workdir, 'epg2xml.py.log'), '--loglevel', 'WARNING',
+           '--deadfile', os.path.join(workdir, 'Channel_DEAD.json'), '--journal', os.path.join(workdir, 'epg2xml.journal'),
+           '--upstream', server.url] + args.args.split()
+    start = time.time()
+    first = None
+    with tempfile.TemporaryFile() as err:
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=err)
+        # 처음 출력 파일이 생길 때까지의 시간 (--progressive 확인용)
+        while proc.poll() is None:
+            if first is None and os.path.exists(xmlfile):
+                first = time.time() - start
+            time.sleep(0.05)
+        elapsed = time.time() - start
+        err.seek(0)
+        stderr = err.read()
+    server.shutdown()
+    server.server_close()
+    if proc.returncode != 0:
+        sys.stderr.write(stderr.decode('utf-8', 'replace'))
+        raise SystemExit('epg2xml.py 실행 실패: channels=%s days=%s' % (channels, days))
+
+    with open(xmlfile, 'r', encoding='utf-8') as f:
+        programmes = sum(line.count('<programme ') for line in f)
+    up = server.upstream
+    return {
+        'channels': channels, 'days': days, 'seconds': elapsed, 'first': first or elapsed, 'requests': up.requests, 'errors': up.errors,
+        'rps': up.requests / elapsed if elapsed else 0.0, 'programmes': programmes,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='epg2xml 부하 테스트')
+    parser.add_argument('--channels', type=int_list, default=[100, 500, 2000], help='채널 수 목록 (기본값: 100,500,2000)')
+    parser.add_argument('--days', type=int_list, default=[1, 3, 7], help='기간(일) 목록, 1-7 (기본값: 1,3,7)')
+    parser.add_argument('--programs', type=int, default=24, help='채널별 하루 프로그램 수 (기본값: 24)')
+    parser.add_argument('--latency', type=float, default=0.0, help='평균 응답 지연 초 (기본값: 0)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='503 응답 비율 0-1 (기본값: 0)')
+    parser.add_argument('--stall-rate', type=float, default=0.0, help='응답을 --stall초 더 늦추는 비율 0-1 (기본값: 0)')
+    parser.add_argument('--stall', type=float, default=5.0, help='늦추는 시간 초 (기본값: 5)')
+    parser.add_argument('--seed', type=int, default=1, help='난수 시드 (기본값: 1)')
+    parser.add_argument('--script', default=os.path.join(__dirpath__, 'epg2xml.py'), help='테스트할 epg2xml.py 경로')
+    parser.add_argument('--args', default='', help='epg2xml.py에 더 넘길 인자 (예: "--progressive")')
+    parser.add_argument('--json', action='store_true', help='결과를 JSON으로 출력')
+    args = parser.parse_args()
+
+    for d in args.days:
+        if not 1 <= d <= 7:
+            parser.error('기간은 1에서 7까지: %s' % d)
+
+    sim = load_sim()
+    results = []
+    if not args.json:
+        print('%8s %5s %10s %8s %9s %7s %10s %11s' % ('channels', 'days', 'seconds', 'first', 'requests', 'errors', 'req/s', 'programmes'))
+    for channels in args.channels:
+        for days in args.days:
+            workdir = tempfile.mkdtemp(prefix='epg2xml-loadtest-')
+            try:
+                script = os.path.join(workdir, 'epg2xml.py')
+                shutil.copy(args.script, script)
+                r = run_once(sim, script, workdir, channels, days, args)
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+            results.append(r)
+            if not args.json:
+                print('%(channels)8d %(days)5d %(seconds)10.2f %(first)8.2f %(requests)9d %(errors)7d %(rps)10.1f %(programmes)11d' % r)
+                sys.stdout.flush()
+    if args.json:
+        print(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
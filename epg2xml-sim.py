@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""epg2xml 업스트림 시뮬레이터
+
+KT, LG, SK, SKB, NAVER, WAVVE, TVING 일곱 소스의 URL을 흉내내는 로컬 서버.
+epg2xml.py를 --upstream http://127.0.0.1:PORT 로 실행하면 모든 요청이
+http://127.0.0.1:PORT/<원래 호스트>/<원래 경로> 로 바뀌어 이 서버로 온다.
+
+응답은 채널 파일(Channel.json)의 ServiceId를 기준으로 합성하며
+지연시간, 에러 비율, 채널 수, 하루 프로그램 수를 조절할 수 있다.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, parse_qs, quote
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+__dirpath__ = os.path.dirname(os.path.realpath(sys.argv[0]))
+SOURCES = ['KT', 'LG', 'SK', 'SKB', 'NAVER', 'WAVVE', 'TVING']
+
+
+class Upstream(object):
+    """채널 목록과 옵션을 가지고 각 소스의 응답 본문을 만든다."""
+
+    def __init__(self, channels, programs=24, latency=0.0, error_rate=0.0, seed=None, stall_rate=0.0, stall=5.0):
+        self.services = {src: [] for src in SOURCES}
+        for ch in channels:
+            if ch.get('Source') in self.services and ch['ServiceId'] not in self.services[ch['Source']]:
+                self.services[ch['Source']].append(ch['ServiceId'])
+        self.programs = max(1, int(programs))
+        self.latency = latency
+        self.error_rate = error_rate
+        self.stall_rate = stall_rate
+        self.stall = stall
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    # 공통
+    def slots(self, day):
+        step = 24 * 60 // self.programs
+        for i in range(self.programs):
+            yield datetime(day.year, day.month, day.day) + timedelta(minutes=i * step), timedelta(minutes=step)
+
+    def title(self, sid, t, i):
+        return '프로그램 %s-%s' % (sid, t.strftime('%H%M')), (i % 20) + 1
+
+    @staticmethod
+    def parse_day(s):
+        return datetime.strptime(s, '%Y%m%d').date()
+
+    # KT
+    def kt_channels(self):
+        items = ''.join('<li><a href="#"><span class="ch">%s</span></a></li>' % quote('%s KT채널%s' % (sid, sid)) for sid in self.services['KT'])
+        return 'text/html', '<ul>%s</ul>' % items
+
+    def kt_schedule(self, q):
+        day = self.parse_day(q['seldate'])
+        sid = q['service_ch_no']
+        rows = {}
+        for i, (t, _) in enumerate(self.slots(day)):
+            rows.setdefault(t.hour, []).append((i, t))
+        html = []
+        for hour, items in sorted(rows.items()):
+            minutes = ''.join('<p>%02d</p>' % t.minute for _, t in items)
+            programs = ''.join('<p>%s <img alt="%s세 이상"></p>' % (self.title(sid, t, i)[0], (12, 15)[i % 2]) for i, t in items)
+            categories = ''.join('<p>드라마</p>' for _ in items)
+            html.append('<tr><td>%02d</td><td>%s</td><td>%s</td><td>%s</td></tr>' % (hour, minutes, programs, categories))
+        return 'text/html', '<table><tbody>%s</tbody></table>' % ''.join(html)
+
+    # LG
+    def lg_schedule(self, q):
+        day = self.parse_day(q['evntCmpYmd'])
+        sid = q['chnlCd']
+        html = []
+        for i, (t, _) in enumerate(self.slots(day)):
+            name, episode = self.title(sid, t, i)
+            html.append('<tr><td>%s</td><td><span class="tagGroup"><span class="tag cte_all">%s</span></span>%s (%s회)%s</td><td>연예</td></tr>'
+                        % (t.strftime('%H:%M'), 'All' if i % 2 else '15', name, episode, ' <재>' if i % 3 == 0 else ''))
+        return 'text/html', '<table><tbody>%s</tbody></table>' % ''.join(html)
+
+    # SK
+    def sk(self, q):
+        if q.get('variable') == 'IF_LIVECHART_ALL':
+            arr = [{'NM_CH': 'SK채널%s' % sid, 'NO_CH': str(n + 1), 'ID_SVC': sid} for n, sid in enumerate(self.services['SK'])]
+            return 'application/json', json.dumps({'result': 'OK', 'ServiceInfoArray': arr})
+        day = self.parse_day(q['o_date'])
+        arr = []
+        for sid in q.get('svc_ids', '').split('|'):
+            if sid not in self.services['SK']:
+                continue
+            events = []
+            for i, (t, d) in enumerate(self.slots(day)):
+                name, episode = self.title(sid, t, i)
+                events.append({
+                    'NM_TITLE': '%s(%s회)' % (name, episode),
+                    'DT_EVNT_START': t.strftime('%Y%m%d%H%M%S'),
+                    'DT_EVNT_END': (t + d).strftime('%Y%m%d%H%M%S'),
+                    'NM_SYNOP': '줄거리 %s' % name,
+                    'AdditionalInfoArray': [{'NM_ACT': '배우1,배우2', 'NM_DIRECTOR': '감독'}],
+                    'CD_GENRE': '1',
+                    'CD_RATING': '15',
+                })
+            arr.append({'ID_SVC': sid, 'EventInfoArray': events})
+        return 'application/json', json.dumps({'result': 'OK', 'ServiceInfoArray': arr})
+
+    # SKB
+    def skb_channels(self):
+        arr = [{'m_name': 'SKB채널%s' % sid, 'ch_no': str(n + 1), 'c_menu': sid, 'depth': '2'} for n, sid in enumerate(self.services['SKB'])]
+        return 'application/json', json.dumps(arr)
+
+    def skb_schedule(self, q):
+        day = self.parse_day(q['key_depth3'])
+        sid = q['key_depth2']
+        html = []
+        for i, (t, _) in enumerate(self.slots(day)):
+            name, episode = self.title(sid, t, i)
+            html.append('<li class="list"><p class="time">%s</p>\n<p class="cont">%s(%s회)%s\n</p><i class="hide">15세 이상</i></li>\n'
+                        % (t.strftime('%H:%M'), name, episode, '(재)' if i % 3 == 0 else ''))
+        return 'text/html', '<div id="uiScheduleTabContent"><ul>\n%s</ul></div>' % ''.join(html)
+
+    # NAVER
+    def naver(self, q):
+        day = self.parse_day(q['u2'])
+        sid = q['u1']
+        html = []
+        for i, (t, _) in enumerate(self.slots(day)):
+            name, _ = self.title(sid, t, i)
+            html.append('<li class="list"><div></div><div>%s</div><div></div><div>%s</div><div>%s</div><div>부제 %s</div></li>'
+                        % (t.strftime('%H:%M'), '<span class="re"></span>' if i % 3 == 0 else '', name, i))
+        return 'application/json', json.dumps({'statusCode': 'SUCCESS', 'dataHtml': ['<ul>%s</ul>' % ''.join(html)]})
+
+    # WAVVE
+    def wavve_epgs(self, q):
+        start = datetime.strptime(q['startdatetime'][:10], '%Y-%m-%d').date()
+        end = datetime.strptime(q['enddatetime'][:10], '%Y-%m-%d').date()
+        offset, limit = int(q.get('offset', 0)), int(q.get('limit', 100))
+        result = []
+        for sid in self.services['WAVVE'][offset:offset + limit]:
+            programs = []
+            day = start
+            while day <= end:
+                for i, (t, d) in enumerate(self.slots(day)):
+                    name, episode = self.title(sid, t, i)
+                    programs.append({
+                        'title': '%s (%s회)' % (name, episode),
+                        'starttime': t.strftime('%Y-%m-%d %H:%M'),
+                        'endtime': (t + d).strftime('%Y-%m-%d %H:%M'),
+                        'targetage': 'n' if i % 2 else '15',
+                        'programid': 'P_%s_%02d' % (sid, i % 8),
+                    })
+                day += timedelta(days=1)
+            result.append({'channelid': sid, 'channelname': 'WAVVE채널%s' % sid, 'channelimage': 'img.example/%s.png' % sid, 'list': programs})
+        return 'application/json', json.dumps({'pagecount': str(len(self.services['WAVVE'])), 'count': str(len(result)), 'list': result})
+
+    def wavve_contentid(self, programid):
+        return 'application/json', json.dumps({'contentid': 'C_' + programid})
+
+    def wavve_contents(self, contentid):
+        return 'application/json', json.dumps({
+            'programsynopsis': '줄거리<br>%s' % contentid,
+            'genretext': '드라마',
+            'programposterimage': 'img.example/%s.jpg' % contentid,
+            'actors': {'list': [{'text': '배우1'}, {'text': '배우2'}]},
+        })
+
+    # TVING
+    def tving(self, q):
+        day = self.parse_day(q['broadDate'])
+        start, end = int(q['startBroadTime'][:2]), int(q['endBroadTime'][:2])
+        page, size = int(q.get('pageNo', 1)), int(q.get('pageSize', 20))
+        codes = q['channelCode'].split(',') if q.get('channelCode') else self.services['TVING']
+        codes = [c for c in codes if c in self.services['TVING']]
+        result = []
+        for sid in codes[(page - 1) * size:page * size]:
+            schedules = []
+            for i, (t, d) in enumerate(self.slots(day)):
+                if not (start <= t.hour < (end or 24)):
+                    continue
+                name, episode = self.title(sid, t, i)
+                schedules.append({
+                    'broadcast_start_time': int(t.strftime('%Y%m%d%H%M%S')),
+                    'broadcast_end_time': int((t + d).strftime('%Y%m%d%H%M%S')),
+                    'rerun_yn': 'Y' if i % 3 == 0 else 'N',
+                    'movie': None,
+                    'program': {
+                        'grade_code': 'CPTG0400',
+                        'name': {'ko': name, 'en': ''},
+                        'category1_name': {'ko': '드라마'},
+                        'actor': ['배우1', '배우2'],
+                        'director': ['감독'],
+                        'image': [{'code': 'CAIP0900', 'url': '/img/%s.jpg' % sid}],
+                        'synopsis': {'ko': '줄거리 %s' % name},
+                    },
+                    'episode': {'frequency': episode, 'synopsis': {'ko': '회차 줄거리 %s' % episode}},
+                })
+            result.append({
+                'channel_code': sid,
+                'channel_name': {'ko': 'TVING채널%s' % sid},
+                'image': [{'code': 'CAIC1600', 'url': '/ch/%s.png' % sid}],
+                'schedules': schedules,
+            })
+        has_more = 'Y' if page * size < len(codes) else 'N'
+        return 'application/json', json.dumps({'header': {'status': 200}, 'body': {'has_more': has_more, 'result': result}})
+
+    def route(self, host, path, q):
+        if host == 'tv.kt.com':
+            return self.kt_channels() if path.endswith('pChList.asp') else self.kt_schedule(q)
+        if host == 'www.uplus.co.kr':
+            return self.lg_schedule(q)
+        if host == 'mapp.btvplus.co.kr':
+            return self.sk(q)
+        if host == 'm.skbroadband.com':
+            return self.skb_channels() if path.endswith('Realtime_List_Ajax.do') else self.skb_schedule(q)
+        if host == 'm.search.naver.com':
+            return self.naver(q)
+        if host == 'apis.pooq.co.kr':
+            if path == '/live/epgs':
+                return self.wavve_epgs(q)
+            if path.startswith('/vod/programs-contentid/'):
+                return self.wavve_contentid(path.rsplit('/', 1)[1])
+            if path.startswith('/vod/contents/'):
+                return self.wavve_contents(path.rsplit('/', 1)[1])
+        if host == 'api.tving.com':
+            return self.tving(q)
+        return None
+
+    def count(self, error):
+        with self.lock:
+            self.requests += 1
+            if error:
+                self.errors += 1
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True     # keep-alive에서 헤더/본문을 따로 보낼 때 생기는 40ms 지연 방지
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def handle_request(self, body=''):
+        upstream = self.server.upstream
+        u = urlparse(self.path)
+        host, _, path = u.path.lstrip('/').partition('/')
+        q = {k: v[0] for k, v in parse_qs(u.query, keep_blank_values=True).items()}
+        q.update({k: v[0] for k, v in parse_qs(body, keep_blank_values=True).items()})
+        if upstream.latency:
+            time.sleep(upstream.random.expovariate(1.0 / upstream.latency))
+        if upstream.stall_rate and upstream.random.random() < upstream.stall_rate:
+            time.sleep(upstream.stall)
+        error = upstream.random.random() < upstream.error_rate
+        upstream.count(error)
+        if error:
+            return self.reply(503, 'text/plain', 'simulated error')
+        try:
+            ret = upstream.route(host, '/' + path, q)
+        except (KeyError, ValueError) as e:
+            return self.reply(400, 'text/plain', 'bad request: %s' % e)
+        if ret is None:
+            return self.reply(404, 'text/plain', 'not found')
+        self.reply(200, *ret)
+
+    def reply(self, code, ctype, body):
+        data = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', ctype + '; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.handle_request(self.rfile.read(length).decode('utf-8'))
+
+
+class SimServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, upstream, verbose=False):
+        HTTPServer.__init__(self, address, Handler)
+        self.upstream = upstream
+        self.verbose = verbose
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.server_address[:2]
+
+    def handle_error(self, request, client_address):
+        # 헤지 요청에서 늦은 쪽은 클라이언트가 끊고 가므로 조용히 넘긴다
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        HTTPServer.handle_error(self, request, client_address)
+
+
+def synthetic_channels(count, sources=None):
+    """count개의 가상 채널을 소스별로 고르게 나누어 만든다."""
+    sources = sources or SOURCES
+    channels = []
+    for i in range(count):
+        src = sources[i % len(sources)]
+        channels.append({
+            'Id': i + 1,
+            'Name': '%s 채널 %s' % (src, i + 1),
+            'KT Name': '', 'KTCh': None, 'LG Name': '', 'LGCh': None, 'SK Name': '', 'SKCh': None,
+            'Icon_url': 'http://img.example/%s.png' % (i + 1),
+            'Source': src,
+            'ServiceId': '%s%s' % ('C' if src in ['WAVVE', 'TVING'] else '', 1000 + i),
+        })
+    return channels
+
+
+def start_server(channels, port=0, host='127.0.0.1', **kwargs):
+    verbose = kwargs.pop('verbose', False)
+    server = SimServer((host, port), Upstream(channels, **kwargs), verbose=verbose)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='epg2xml 업스트림 시뮬레이터')
+    parser.add_argument('--host', default='127.0.0.1', help='바인드 주소 (기본값: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8080, help='포트 (기본값: 8080)')
+    parser.add_argument('--channelfile', default=os.path.join(__dirpath__, 'Channel.json'), help='서비스 아이디를 가져올 채널 파일')
+    parser.add_argument('--channels', type=int, metavar='N', help='채널 파일 대신 N개의 가상 채널 사용')
+    parser.add_argument('--programs', type=int, default=24, help='채널별 하루 프로그램 수 (기본값: 24)')
+    parser.add_argument('--latency', type=float, default=0.0, help='평균 응답 지연 초 (기본값: 0)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='503 응답 비율 0-1 (기본값: 0)')
+    parser.add_argument('--stall-rate', type=float, default=0.0, help='응답을 --stall초 더 늦추는 비율 0-1 (기본값: 0)')
+    parser.add_argument('--stall', type=float, default=5.0, help='늦추는 시간 초 (기본값: 5)')
+    parser.add_argument('--seed', type=int, help='난수 시드')
+    parser.add_argument('--verbose', action='store_true', help='요청 로그 출력')
+    args = parser.parse_args()
+
+    if args.channels:
+        channels = synthetic_channels(args.channels)
+    else:
+        with open(args.channelfile, 'r', encoding='utf-8') as f:
+            channels = json.load(f)
+    server = SimServer((args.host, args.port), Upstream(channels, args.programs, args.latency, args.error_rate, args.seed, args.stall_rate, args.stall), args.verbose)
+    sys.stderr.write('시뮬레이터 시작: %s\n' % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    sys.stderr.write('요청 %s건, 에러 %s건\n' % (server.upstream.requests, server.upstream.errors))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,34 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import io
 import os
+import atexit
 import re
 import sys
+import gzip
 import time
+import zlib
 import json
+import hashlib
+import queue
 import socket
+import sqlite3
 import logging
 import argparse
-from functools import partial
-from urllib.parse import unquote
-from logging.handlers import RotatingFileHandler
+import tempfile
+import threading
+from bisect import bisect_left, bisect_right, insort
+from functools import partial, lru_cache
+from itertools import chain
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError
+from urllib.parse import unquote, urlparse, parse_qs
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from datetime import datetime, timedelta, date
 from xml.sax.saxutils import escape, unescape
+from xml.etree.ElementTree import iterparse, tostring
 
 #
 # default variables
@@ -22,12 +38,29 @@ today = date.today()
 ua = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/77.0.3865.90 Safari/537.36'
 req_timeout = 15
 req_sleep = 1
+latency_samples = 20   # 호스트와 경로별 응답 시간이 이만큼 모이면 그 분포로 타임아웃과 헤지 시점을 정한다
+store_days = 7     # 저장소에 지난 프로그램을 남겨두는 일수
+plan_latency = 0.5     # --plan에서 지난 실행 기록이 없는 호스트의 응답 시간(초)
+
+# 소스별로 EPG를 요청하는 호스트 (--plan)
+SourceHosts = OrderedDict([
+    ('KT', 'tv.kt.com'),
+    ('LG', 'www.uplus.co.kr'),
+    ('SK', 'mapp.btvplus.co.kr'),
+    ('SKB', 'm.skbroadband.com'),
+    ('NAVER', 'm.search.naver.com'),
+    ('WAVVE', 'apis.pooq.co.kr'),
+    ('TVING', 'api.tving.com'),
+])
 
 # importtant files
 __dirpath__ = os.path.dirname(os.path.realpath(sys.argv[0]))
 logfile = os.path.join(__dirpath__, 'epg2xml.py.log')
 configfile = os.path.join(__dirpath__, 'epg2xml.json')
 channelfile = os.path.join(__dirpath__, 'Channel.json')
+deadfile = os.path.join(__dirpath__, 'Channel_DEAD.json')
+journalfile = os.path.join(__dirpath__, 'epg2xml.journal')
+storefile = os.path.join(__dirpath__, 'epg2xml.db')
 
 # parse command-line arguments
 parser = argparse.ArgumentParser(description='EPG 정보를 XML로 만드는 프로그램')
@@ -36,17 +69,32 @@ parser.add_argument('--config', dest='configfile', default=configfile, help='설
 parser.add_argument('--logfile', default=logfile, help='로그 파일 경로 (기본값: %s)' % logfile)
 parser.add_argument('--loglevel', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='INFO', help='로그 레벨 (기본값: INFO)')
 parser.add_argument('--channelfile', default=channelfile, help='채널 파일 경로 (기본값: %s)' % channelfile)
+parser.add_argument('--deadfile', default=deadfile, help='EPG가 없는 채널 기록 파일 경로 (기본값: %s)' % deadfile)
+parser.add_argument('--journal', default=journalfile, help='작업 기록 파일 경로 (기본값: %s)' % journalfile)
+parser.add_argument('--resume', action='store_true', help='중간에 멈춘 실행을 작업 기록에서 이어서 실행')
+parser.add_argument('--progressive', action='store_true', help='오늘 EPG를 먼저 가져와서 파일/소켓으로 출력한 뒤 나머지 날을 가져와서 다시 출력')
+parser.add_argument('--store', default=storefile, help='EPG 저장소(SQLite) 파일 경로 (기본값: %s)' % storefile)
+parser.add_argument('--render', action='store_true', help='EPG를 가져오지 않고 저장소에 있는 것으로 출력')
+parser.add_argument('--serve', metavar='[HOST:]PORT', help='출력을 마친 뒤 채널/시간 범위로 EPG를 조회하는 HTTP 서버 실행 (예: 0.0.0.0:8080, 기본 HOST: 127.0.0.1)')
+parser.add_argument('--shard', metavar='i/N', help='채널을 Source와 ServiceId로 N개로 나누어 그중 i번째(1-N)만 가져옴')
+parser.add_argument('--merge', metavar='XMLTVFILE', nargs='+', help='EPG를 가져오지 않고 샤드 출력 파일들을 합쳐서 출력 (.gz/.xz 가능)')
+parser.add_argument('--plan', action='store_true', help='EPG를 가져오지 않고 가져올 채널과 소스/호스트별 요청 계획, 예상 시간을 출력 (네트워크 요청 없음)')
+parser.add_argument('--upstream', metavar='URL', help='모든 요청을 URL/원래호스트/원래경로로 보내고 요청 간 대기를 하지 않음 (시뮬레이터 테스트용, 예: http://127.0.0.1:8080)')
 parser.add_argument('-i', '--isp', dest='MyISP', choices=['ALL', 'KT', 'LG', 'SK'], help='사용하는 ISP 선택')
 parser.add_argument('-c', '--channelid', dest='MyChannels', metavar='CHANNELID', help='채널 ID를 ,와 -, *를 적절히 조합하여 지정 (예: -3,5,7-9,11-)')
-arg1 = parser.add_mutually_exclusive_group()
-arg1.add_argument('-d', '--display', dest='output', action='store_const', const='d', help='생성된 EPG를 화면에 출력')
-arg1.add_argument('-o', '--outfile', dest='default_xml_file', metavar='XMLTVFILE', nargs='?', const='xmltv.xml', help='생성된 EPG를 파일로 저장 (기본경로: %s)' % 'xmltv.xml')
-arg1.add_argument('-s', '--socket', dest='default_xml_socket', metavar='XMLTVSOCK', nargs='?', const='xmltv.sock', help='생성된 EPG를 소켓으로 전송 (기본경로: %s)' % 'xmltv.sock')
+arg1 = parser.add_argument_group('출력', '여러 개를 함께 지정하면 한 번 만든 EPG를 모두에 동시에 출력')
+arg1.add_argument('-d', '--display', dest='output', action='append_const', const='d', help='생성된 EPG를 화면에 출력')
+arg1.add_argument('-o', '--outfile', dest='default_xml_file', metavar='XMLTVFILE', action='append', nargs='?', const='xmltv.xml', help='생성된 EPG를 파일로 저장, 확장자가 .gz/.xz이면 압축 (기본경로: %s)' % 'xmltv.xml')
+arg1.add_argument('-s', '--socket', dest='default_xml_socket', metavar='XMLTVSOCK', action='append', nargs='?', const='xmltv.sock', help='생성된 EPG를 소켓으로 전송 (기본경로: %s)' % 'xmltv.sock')
 args = vars(parser.parse_args())
+outputs = args['output'] or []
 if args['default_xml_file']:
-    args['output'] = 'o'
-elif args['default_xml_socket']:
-    args['output'] = 's'
+    outputs.append('o')
+if args['default_xml_socket']:
+    outputs.append('s')
+args['output'] = ','.join(outputs)
+if args['upstream']:
+    req_sleep = 0
 
 #
 # logging
@@ -59,12 +107,17 @@ formatter = logging.Formatter(log_fmt, datefmt='%Y/%m/%d %H:%M:%S')
 # logging to file
 filehandler = RotatingFileHandler(args['logfile'], maxBytes=1024 * 1000, backupCount=5, encoding='utf-8')
 filehandler.setFormatter(formatter)
-log.addHandler(filehandler)
 
 # logging to console, stderr by default
 consolehandler = logging.StreamHandler()
 consolehandler.setFormatter(formatter)
-log.addHandler(consolehandler)
+
+# 파일/콘솔 쓰기는 별도 스레드에서 하여 EPG 작업을 막지 않는다
+logqueue = queue.Queue(-1)
+log.addHandler(QueueHandler(logqueue))
+loglistener = QueueListener(logqueue, filehandler, consolehandler, respect_handler_level=True)
+loglistener.start()
+atexit.register(loglistener.stop)
 
 log.setLevel(getattr(logging, args['loglevel']))
 
@@ -87,6 +140,38 @@ try:
 except ImportError:
     log.error("requests 모듈이 설치되지 않았습니다.")
     sys.exit(1)
+try:
+    import lzma
+except ImportError:
+    lzma = None
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# JSON 모듈: orjson > ujson > json 순으로 있는 것을 사용
+# json_loads는 bytes/str을 모두 받고, json_dumps는 str을 돌려준다
+try:
+    import orjson
+
+    json_loads = orjson.loads
+
+    def json_dumps(data, indent=False):
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if indent else 0).decode('utf-8')
+except ImportError:
+    try:
+        import ujson
+
+        json_loads = ujson.loads
+
+        def json_dumps(data, indent=False):
+            return ujson.dumps(data, ensure_ascii=False, escape_forward_slashes=False, indent=4 if indent else 0)
+    except ImportError:
+        def json_loads(data):
+            return json.loads(data.decode('utf-8') if isinstance(data, bytes) else data)
+
+        def json_dumps(data, indent=False):
+            return json.dumps(data, ensure_ascii=False, indent=4 if indent else None)
 
 if list(sys.version_info[:2]) < [3, 5]:
     log.error("python 3.5+에서 실행하세요.")
@@ -95,51 +180,371 @@ if list(sys.version_info[:2]) < [3, 5]:
 
 # Get epg data
 def getEpg():
-    # XML 헤더 시작
-    print('<?xml version="1.0" encoding="UTF-8"?>')
-    print('<!DOCTYPE tv SYSTEM "xmltv.dtd">\n')
-    print('<tv generator-info-name="epg2xml ' + __version__ + '">')
-
-    ChannelInfos = []
-    for Channeldata in Channeldatajson:     # Get Channel & Print Channel info
-        if (Channeldata['Source'] in ['KT', 'LG', 'SK', 'SKB', 'NAVER']) and (str(Channeldata['Id']) in MyChannels):
-            ChannelId = Channeldata['Id']
-            ChannelName = escape(Channeldata['Name'])
-            ChannelSource = Channeldata['Source']
-            ChannelServiceId = Channeldata['ServiceId']
-            ChannelIconUrl = escape(Channeldata['Icon_url'])
-            ChannelInfos.append([ChannelId, ChannelName, ChannelSource, ChannelServiceId])
-            print('  <channel id="%s">' % ChannelId)
-            if MyISP != "ALL" and Channeldata[MyISP+'Ch'] is not None:
-                ChannelNumber = str(Channeldata[MyISP+'Ch'])
-                ChannelISPName = escape(Channeldata[MyISP+' Name'])
-                print('    <display-name>%s</display-name>' % ChannelName)
-                print('    <display-name>%s</display-name>' % ChannelISPName)
-                print('    <display-name>%s</display-name>' % ChannelNumber)
-                print('    <display-name>%s</display-name>' % (ChannelNumber+' '+ChannelISPName))
-            elif MyISP == "ALL":
-                print('    <display-name>%s</display-name>' % ChannelName)
-            if IconUrl:
-                print('    <icon src="%s/%s.png" />' % (IconUrl, ChannelId))
-            else:
-                print('    <icon src="%s" />' % ChannelIconUrl)
-            print('  </channel>')
+    ChannelInfos = selectChannels()
+    previews = []
+
+    if args['progressive'] and period > 1:
+        # 오늘 EPG를 모든 채널에 대해 먼저 가져와서 화면을 뺀 출력으로 먼저 내보낸다
+        fetchEpg(ChannelInfos, range(0, 1))
+        storeEpg(keep=True)
+        for profile in profiles:
+            preview = open_output(profile, preview=True)
+            if preview is not None:
+                # 느린 소켓 소비자가 나머지 날짜를 가져오는 것을 늦추지 않도록 소켓은 기다리지 않는다
+                writeXML(dict(profile, output=preview), wait=False)
+                previews.append(preview)
+        log.info('오늘 EPG를 먼저 출력했습니다. 나머지 %s일을 가져옵니다.', period - 1)
+        fetchEpg(ChannelInfos, range(1, period))
+    else:
+        fetchEpg(ChannelInfos, range(0, period))
+    store.put_stats(request_stats)
+    storeEpg()
+    if store.reused:
+        log.info('다시 요청하지 않고 지난 결과를 사용한 요청 단위: %s개', store.reused)
+    log.info('요청 %s건%s', request_count, ' (예산 %s건)' % request_budget if request_budget > 0 else '')
+    reportLatencies()
+
+    saveDeadServices()
+    reportDeadServices()
+
+    # 가져온 EPG를 프로파일마다 출력
+    for profile in profiles:
+        writeXML(profile)
+    for preview in previews:
+        preview.join()
+    log.info('종료합니다.')
 
-    # Print Program Information
-    GetEPGFromKT([info for info in ChannelInfos if info[2] == 'KT'])
-    GetEPGFromLG([info for info in ChannelInfos if info[2] == 'LG'])
-    GetEPGFromSK([info for info in ChannelInfos if info[2] == 'SK'])
-    GetEPGFromSKB([info for info in ChannelInfos if info[2] == 'SKB'])
-    GetEPGFromNaver([info for info in ChannelInfos if info[2] == 'NAVER'])
+
+def selectChannels():
+    # 모든 프로파일이 필요로 하는 채널을 한 번만, 같은 서비스를 가리키는 채널은 한 번만 가져온다
+    selected = []
+    for Channeldata in Channeldatajson:     # Get Channel info
+        if (Channeldata['Source'] in ['KT', 'LG', 'SK', 'SKB', 'NAVER']) and (str(Channeldata['Id']) in MyChannels) and inShard(Channeldata):
+            addChannel(Channeldata)
+            selected.append(Channeldata)
+    return [[x['Id'], escape(x['Name']), x['Source'], x['ServiceId']] for x in uniqueServices(selected)]
+
+
+def otherChannels():
+    # WAVVE, TVING은 MyChannels와 상관없이 모두 가져온다
+    return uniqueServices([c for c in Channeldatajson if c['Source'] in ['WAVVE', 'TVING'] and inShard(c)])
+
+
+def uniqueServices(channels):
+    """(Source, ServiceId)가 같은 채널은 처음 것만 남기고 나머지는 AliasOf에 처음 채널의 Id로 기록한다
+
+    처음 채널은 묶인 채널 중 가장 높은 우선순위와 가장 긴 일수로 가져온다.
+    """
+    unique = OrderedDict()
+    for c in channels:
+        key = (c['Source'], str(c['ServiceId']), 'Id' in c)
+        if key not in unique:
+            unique[key] = c
+        elif 'Id' in c and c['Id'] != unique[key]['Id']:
+            ChannelId = unique[key]['Id']
+            AliasOf[c['Id']] = ChannelId
+            ChannelPlans[str(ChannelId)] = (min(priorityOf(ChannelId), priorityOf(c['Id'])), max(depthOf(ChannelId), depthOf(c['Id'])))
+    return list(unique.values())
+
+
+def addAliasChannels():
+    # 같은 서비스를 가리키는 다른 채널(WAVVE, TVING)도 가져온 채널 정보에 그 채널의 이름과 아이콘으로 출력
+    for c in Channeldatajson:
+        ChannelId = AliasOf.get(c.get('Id'))
+        if c['Source'] in ['WAVVE', 'TVING'] and ChannelId in EPGChannels and c['Id'] not in EPGChannels:
+            channel = EPGChannels[ChannelId]
+            addChannel(dict(channel, Id=c['Id'], Name=c.get('Name', channel['Name']), Icon_url=c.get('Icon_url', channel['Icon_url'])))
+
+
+def planEpg():
+    # EPG를 가져오지 않고 getEpg()가 보낼 요청을 소스/호스트별로 세어서 예상 시간과 함께 화면에 출력
+    ChannelInfos = selectChannels()
+    plan = OrderedDict()
+    if args['progressive'] and period > 1:
+        planFetch(ChannelInfos, range(0, 1), plan)
+        planFetch(ChannelInfos, range(1, period), plan)
+    else:
+        planFetch(ChannelInfos, range(0, period), plan)
+
+    print('%-6s %-22s %6s %8s %10s %10s' % ('소스', '호스트', '채널', '요청', '예상(초)', '지연(초)'))
+    total_requests, total_seconds, estimated = 0, 0.0, False
+    for source, entry in plan.items():
+        host = SourceHosts[source]
+        stat = store.get_stat(host)
+        latency = stat[1] / stat[0] if stat and stat[0] else plan_latency
+        # SK 묶음과 WAVVE 페이지(parallel)는 workers개씩 동시에 보내고 각자 기다린다
+        seconds = (entry['requests'] - entry['parallel'] + entry['parallel'] / float(workers)) * (latency + req_sleep)
+        print('%-6s %-22s %6s %8s %10.1f %10s' % (source, host, len(entry['channels']),
+                                                   ('~' if entry['estimated'] else '') + str(entry['requests']),
+                                                   seconds, '%.3f' % latency + ('' if stat else '*')))
+        total_requests += entry['requests']
+        total_seconds += seconds
+        estimated = estimated or entry['estimated']
+    print('%-6s %-22s %6s %8s %10.1f' % ('합계', '', sum(len(x['channels']) for x in plan.values()),
+                                        ('~' if estimated else '') + str(total_requests), total_seconds))
+    print('~: 지난 실행 기록으로 추정한 요청 수, *: 기록이 없어 %s초로 가정한 응답 시간, 요청마다 %s초 대기 (SK 묶음과 WAVVE 페이지는 %s개씩 동시에)'
+          % (plan_latency, req_sleep, workers))
+    if 0 < request_budget < total_requests:
+        print('요청 예산 %s건에서 멈춥니다. 우선순위가 낮은 채널과 날짜는 가져오지 않습니다.' % request_budget)
+
+
+def planFetch(ChannelInfos, days, plan):
+    # fetchEpg()와 같은 순서로 days에 보낼 요청을 plan(소스별 채널과 요청 수)에 더한다
+    # 작업 기록이나 저장소에 있어서 다시 요청하지 않을 단위는 세지 않는다
+    global fetch_days
+    fetch_days = days
+
+    for priority in sorted(set([priorityOf(info[0]) for info in ChannelInfos])):
+        infos = [info for info in ChannelInfos if priorityOf(info[0]) == priority]
+        for source in ['KT', 'LG', 'SK', 'SKB', 'NAVER']:
+            planSource(source, [(info[0], info[3]) for info in infos if info[2] == source], plan)
+    others = otherChannels()
+    for source in ['WAVVE', 'TVING']:
+        planSource(source, [(c.get('Id'), c['ServiceId']) for c in others if c['Source'] == source], plan)
+
+
+def planSource(source, channels, plan):
+    """한 소스가 channels((Id, ServiceId) 목록)를 가져오며 보낼 요청 수를 plan에 더한다"""
+    if not channels:
+        return
+    entry = plan.setdefault(source, {'channels': set(), 'requests': 0, 'parallel': 0, 'estimated': False})
+    requested = channels
+    channels = [x for x in channels if not isDeadService(source, x[1])]
+    entry['channels'].update(x[0] for x in channels)
+    for x in channels:
+        log.debug('계획: %s %s %s', source, x[0], x[1])
+
+    def ymd(k):
+        return (today + timedelta(days=k)).strftime('%Y%m%d')
+
+    def dumped(name):
+        # 지난 실행에서 저장한 소스의 전체 채널 수, 없으면 0
+        try:
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Channel_%s.json' % name), 'rb') as f:
+                return int(json_loads(f.read())[0]['total'])
+        except Exception:
+            return 0
+
+    if source in ['KT', 'LG', 'SKB', 'NAVER']:
+        # 채널 목록 한 번(KT, SKB)과 채널/날짜마다 한 번
+        entry['requests'] += 1 if source in ['KT', 'SKB'] else 0
+        for ChannelId, ServiceId in channels:
+            entry['requests'] += len([k for k in fetchDays(ChannelId) if cached(source, ServiceId, ymd(k)) is None])
+    elif source == 'SK':
+        # 채널 목록 한 번과 날마다 가져오지 않은 채널 sk_chunk_size개에 한 번
+        entry['requests'] += 1
+        for k in fetchDays(*[x[0] for x in channels]):
+            missing = len([x for x in channels if k < depthOf(x[0]) and cached('SK', x[1], ymd(k)) is None])
+            entry['requests'] += -(-missing // sk_chunk_size)
+            entry['parallel'] += -(-missing // sk_chunk_size)
+    elif source == 'WAVVE':
+        # 기간(wavve_daily이면 날)마다 전체 채널 100개씩 한 번과
+        # 처음 보는 프로그램마다 상세 정보 두 번 (지난 실행의 채널/일당 프로그램 수로 추정)
+        days = fetchDays(*[x[0] for x in channels])
+        if not days:
+            return
+        total = dumped('WAVVE')
+        wanted_key = servicesKey(x[1] for x in requested)
+        entry['estimated'] = entry['estimated'] or not total
+        for span in [ymd(k) for k in days] if wavve_daily else [ymd(days[0]) + ('-' + ymd(days[-1]) if len(days) > 1 else '')]:
+            for offset in range(0, max(total, 1), 100):
+                if cached('WAVVE', 'offset|%s|%s' % (offset, wanted_key), span) is None:
+                    entry['requests'] += 1
+                    entry['parallel'] += 1
+        details, channel_days = store.get_stat('WAVVE|details'), store.get_stat('WAVVE|channel-days')
+        if details and channel_days and channel_days[0]:
+            entry['requests'] += int(round(2.0 * details[0] / channel_days[0] * len(channels) * len(days)))
+            entry['estimated'] = True
+    elif source == 'TVING':
+        # 채널 목록(20개씩)과 가져오지 않은 날마다 3시간 간격 8번 x 페이지 수
+        total = dumped('TVING')
+        pages = -(-len(channels) // 20)
+        entry['requests'] += max(-(-total // 20), 1)
+        entry['estimated'] = entry['estimated'] or not total
+        unit = '*|' + servicesKey(x[1].strip() for x in channels)
+        entry['requests'] += 8 * pages * len([k for k in fetchDays(*[x[0] for x in channels]) if cached('TVING', unit, ymd(k)) is None])
+
+
+def fetchEpg(ChannelInfos, days):
+    # 오늘부터 days에 있는 날(0: 오늘)의 EPG를 가져온다
+    global fetch_days
+    fetch_days = days
+
+    # 채널마다 요청하는 소스는 우선순위(숫자가 작을수록 먼저)대로 가져와서 요청 예산도 그 순서로 쓴다
+    priorities = sorted(set([priorityOf(info[0]) for info in ChannelInfos]))
+    for priority in priorities:
+        if len(priorities) > 1:
+            log.info('우선순위 %s인 채널을 가져옵니다.', priority)
+        infos = [info for info in ChannelInfos if priorityOf(info[0]) == priority]
+
+        # Get Program Information
+        GetEPGFromKT([info for info in infos if info[2] == 'KT'])
+        GetEPGFromLG([info for info in infos if info[2] == 'LG'])
+        GetEPGFromSK([info for info in infos if info[2] == 'SK'])
+        GetEPGFromSKB([info for info in infos if info[2] == 'SKB'])
+        GetEPGFromNaver([info for info in infos if info[2] == 'NAVER'])
 
     # 여기서부터는 기존의 채널 필터(My Channel)를 사용하지 않음
-    GetEPGFromWAVVE([c for c in Channeldatajson if c['Source'] == 'WAVVE'])
-    GetEPGFromTVING([c for c in Channeldatajson if c['Source'] == 'TVING'])
+    # 전체 편성표를 한꺼번에 받는 소스라서 모든 채널을 가장 긴 일수로 한 번에 가져오고 편성표 요청은 예산에서 빼지 않는다
+    others = otherChannels()
+    GetEPGFromWAVVE([c for c in others if c['Source'] == 'WAVVE'])
+    GetEPGFromTVING([c for c in others if c['Source'] == 'TVING'])
+    addAliasChannels()
+
+
+def depthOf(ChannelId):
+    # 채널을 가져오는 일수
+    return ChannelPlans.get(str(ChannelId), default_plan)[1]
+
+
+def priorityOf(ChannelId):
+    return ChannelPlans.get(str(ChannelId), default_plan)[0]
 
-    print('</tv>')
+
+def fetchDays(*ChannelIds):
+    """지금 가져오는 날(fetch_days) 중에서 주어진 채널들 중 가장 오래 가져오는 채널이 가져올 날"""
+    depth = max([depthOf(x) for x in ChannelIds] or [0])
+    return [k for k in fetch_days if k < depth]
+
+
+def storeEpg(keep=False):
+    # 채널별로 정렬하고 중복/겹침을 정리해서 저장소에 넣는다
+    # keep이면 다음에 가져올 날과 함께 다시 정리하도록 가져온 프로그램을 남겨둔다
+    # 같은 서비스를 가리키는 채널(AliasOf)은 한 번 가져온 프로그램을 그 채널 Id로 바꿔서 저장한다
+    shared = set(AliasOf.values())
+    timelines = {}
+    for ChannelId, channel in EPGChannels.items():
+        SourceId = AliasOf.get(ChannelId, ChannelId)
+        if SourceId in timelines:
+            timeline = timelines[SourceId]
+        else:
+            timeline = buildTimeline(EPGPrograms.get(SourceId, []) if keep else EPGPrograms.pop(SourceId, []))
+            if SourceId in shared:
+                timelines[SourceId] = timeline
+        if SourceId != ChannelId:
+            timeline = [dict(x, channelId=ChannelId) for x in timeline]
+        store.put_channel(channel)
+        store.put_programs(ChannelId, channel['Source'], timeline)
+    store.commit()
+
+
+def inShard(channel):
+    # 같은 서비스는 항상 같은 샤드가 맡도록 Source와 ServiceId의 해시로 나눈다
+    if shard is None:
+        return True
+    key = '%s|%s' % (channel['Source'], channel['ServiceId'])
+    return zlib.crc32(key.encode('utf-8')) % shard[1] == shard[0] - 1
+
+
+def mergeEpg(files):
+    # 샤드 출력 파일들을 채널 목록 먼저, 그 다음 파일 순서대로 프로그램을 이어서 하나의 XMLTV로 합친다
+    # 파일마다 두 번(채널, 프로그램) 읽으며 요소 하나씩만 메모리에 둔다
+    for profile in profiles:
+        out = profile['output']
+        try:
+            writeXMLHeader(out)
+            counts = {'channel': 0, 'programme': 0}
+            for tag in ['channel', 'programme']:
+                for file_path in files:
+                    for elem in iterXMLTV(file_path, tag):
+                        elem.tail = None
+                        print('  ' + tostring(elem, encoding='unicode'), file=out)
+                        counts[tag] += 1
+            print('</tv>', file=out)
+        except Exception:
+            out.abort()
+            raise
+        out.commit()
+        log.info('%s 프로파일 병합 출력 완료: 파일 %s개, 채널 %s개, 프로그램 %s개', profile['name'], len(files), counts['channel'], counts['programme'])
     log.info('종료합니다.')
 
 
+def iterXMLTV(file_path, tag):
+    """XMLTV 파일에서 최상위 tag 요소를 하나씩 (.gz/.xz는 압축을 풀면서)"""
+    if file_path.endswith('.gz'):
+        f = gzip.open(file_path, 'rb')
+    elif file_path.endswith('.xz') and lzma is not None:
+        f = lzma.open(file_path, 'rb')
+    else:
+        f = open(file_path, 'rb')
+    with f:
+        root = None
+        for event, elem in iterparse(f, events=('start', 'end')):
+            if root is None:
+                root = elem
+                if root.tag != 'tv':
+                    raise ValueError('XMLTV 파일이 아닙니다: %s' % file_path)
+            elif event == 'end' and elem.tag in ('channel', 'programme'):
+                if elem.tag == tag:
+                    yield elem
+                root.clear()
+
+
+def renderEpg():
+    # EPG를 가져오지 않고 저장소에 있는 마지막 EPG를 출력
+    for channel in store.channels():
+        addChannel(channel)
+    log.info('저장소에서 출력합니다: %s개 채널', len(EPGChannels))
+    for profile in profiles:
+        writeXML(profile)
+    log.info('종료합니다.')
+
+
+def writeXML(profile, wait=True):
+    out = profile['output']
+    try:
+        writeXMLHeader(out)
+        ChannelIds = [ChannelId for ChannelId, channel in EPGChannels.items() if channel['Source'] in ['WAVVE', 'TVING'] or str(ChannelId) in profile['MyChannels']]
+        for ChannelId in ChannelIds:
+            writeChannel(EPGChannels[ChannelId], profile)
+        for ChannelId in ChannelIds:
+            for programdata in store.programs(ChannelId):
+                writeProgram(programdata, profile)
+        print('</tv>', file=out)
+    except Exception:
+        out.abort()
+        raise
+    out.commit(wait)
+    log.info('%s 프로파일 출력 완료: %s개 채널', profile['name'], len(ChannelIds))
+
+
+def writeXMLHeader(out):
+    print('<?xml version="1.0" encoding="UTF-8"?>', file=out)
+    print('<!DOCTYPE tv SYSTEM "xmltv.dtd">\n', file=out)
+    print('<tv generator-info-name="epg2xml ' + __version__ + '">', file=out)
+
+
+def addChannel(channel):
+    EPGChannels[channel['Id']] = channel
+
+
+def writeChannel(channel, profile):
+    out = profile['output']
+    ChannelId = channel['Id']
+    print('  <channel id="%s">' % ChannelId, file=out)
+    if channel['Source'] in ['WAVVE', 'TVING']:
+        print('    <icon src="%s" />' % escape(channel['Icon_url']), file=out)
+        print('    <display-name>%s</display-name>' % escape(channel['Name']), file=out)
+        print('  </channel>', file=out)
+        return
+    MyISP = profile['MyISP']
+    ChannelName = escape(channel['Name'])
+    if MyISP != "ALL" and channel[MyISP+'Ch'] is not None:
+        ChannelNumber = str(channel[MyISP+'Ch'])
+        ChannelISPName = escape(channel[MyISP+' Name'])
+        print('    <display-name>%s</display-name>' % ChannelName, file=out)
+        print('    <display-name>%s</display-name>' % ChannelISPName, file=out)
+        print('    <display-name>%s</display-name>' % ChannelNumber, file=out)
+        print('    <display-name>%s</display-name>' % (ChannelNumber+' '+ChannelISPName), file=out)
+    elif MyISP == "ALL":
+        print('    <display-name>%s</display-name>' % ChannelName, file=out)
+    if profile['IconUrl']:
+        print('    <icon src="%s/%s.png" />' % (profile['IconUrl'], ChannelId), file=out)
+    else:
+        print('    <icon src="%s" />' % escape(channel['Icon_url']), file=out)
+    print('  </channel>', file=out)
+
+
 def GetEPGFromKT(ChannelInfos):
     if ChannelInfos:
         log.info('소스가 KT인 채널을 가져오고 있습니다.')
@@ -174,34 +579,40 @@ def GetEPGFromKT(ChannelInfos):
         all_services = [x['ServiceId'] for x in all_channels]
     except Exception as e:
         log.error('체널 목록을 가져오지 못했습니다: %s', str(e))
-        all_services = [x[3] for x in ChannelInfos]
+        all_services = None
+
+    def get_programs(ChannelInfo, ymd):
+        data = request_data(url, dict(params, service_ch_no=ChannelInfo[3], seldate=ymd), method='POST', output='html', session=sess)
+        if not data:
+            raise ValueError('응답이 없습니다')
+        epginfo = []
+        soup = BeautifulSoup(data, htmlparser, parse_only=SoupStrainer('tbody'))
+        for row in soup.find_all('tr'):
+            cell = row.find_all('td')
+            for minute, program, category in zip(cell[1].find_all('p'), cell[2].find_all('p'), cell[3].find_all('p')):
+                startTime = epgtime(ymd, cell[0].text.strip() + ':' + minute.text.strip())
+                programName = program.text.replace('방송중 ', '').strip()
+                category = category.text.strip()
+                rating = 0
+                for image in program.find_all('img', alt=True):
+                    grade = re.match('([\d,]+)', image['alt'])
+                    if grade:
+                        rating = int(grade.group(1))
+                epginfo.append([ChannelInfo[0], startTime, programName, '', '', '', '', category, '', False, rating])
+        return epginfo
 
     for ChannelInfo in ChannelInfos:
-        if ChannelInfo[3] not in all_services:
-            log.warning('없는 서비스 아이디입니다: %s', ChannelInfo)
+        if not availableService('KT', ChannelInfo[3], all_services, ChannelInfo):
             continue
         epginfo = []
-        for k in range(period):
-            day = today + timedelta(days=k)
-            params.update({'service_ch_no': ChannelInfo[3], 'seldate': day.strftime('%Y%m%d')})
+        for k in fetchDays(ChannelInfo[0]):
+            ymd = (today + timedelta(days=k)).strftime('%Y%m%d')
             try:
-                data = request_data(url, params, method='POST', output='html', session=sess)
-                soup = BeautifulSoup(data, htmlparser, parse_only=SoupStrainer('tbody'))
-                for row in soup.find_all('tr'):
-                    cell = row.find_all('td')
-                    for minute, program, category in zip(cell[1].find_all('p'), cell[2].find_all('p'), cell[3].find_all('p')):
-                        startTime = str(day) + ' ' + cell[0].text.strip() + ':' + minute.text.strip()
-                        startTime = datetime.strptime(startTime, '%Y-%m-%d %H:%M').strftime('%Y%m%d%H%M%S')
-                        programName = program.text.replace('방송중 ', '').strip()
-                        category = category.text.strip()
-                        rating = 0
-                        for image in program.find_all('img', alt=True):
-                            grade = re.match('([\d,]+)', image['alt'])
-                            if grade:
-                                rating = int(grade.group(1))
-                        epginfo.append([ChannelInfo[0], startTime, programName, '', '', '', '', category, '', False, rating])
+                epginfo.extend(checkpoint('KT', ChannelInfo[3], ymd, partial(get_programs, ChannelInfo, ymd)))
+            except BudgetExceeded:
+                break
             except Exception as e:
-                log.error('파싱 에러: %s: %s' % (ChannelInfo, str(e)))
+                log.error('파싱 에러: %s: %s', ChannelInfo, str(e))
         epgzip(epginfo)
 
 
@@ -218,39 +629,56 @@ def GetEPGFromLG(ChannelInfos):
     sess = requests.session()
     sess.headers.update({'User-Agent': ua, 'Referer': referer})
 
+    def get_programs(ChannelInfo, ymd):
+        data = request_data(url, dict(params, chnlCd=ChannelInfo[3], evntCmpYmd=ymd), method='POST', output='html', session=sess)
+        if not data:
+            raise ValueError('응답이 없습니다')
+        epginfo = []
+        data = data.replace('<재>', '&lt;재&gt;').replace(' [..', '').replace(' (..', '')
+        soup = BeautifulSoup(data, htmlparser, parse_only=SoupStrainer('table'))
+        if not str(soup):
+            return epginfo
+        for row in soup.find('table').tbody.find_all('tr'):
+            cell = row.find_all('td')
+            startTime = epgtime(ymd, cell[0].text)
+            rating_str = cell[1].find('span', {'class': 'tag cte_all'}).text.strip()
+            rating = 0 if rating_str == 'All' else int(rating_str)
+            cell[1].find('span', {'class': 'tagGroup'}).decompose()
+            pattern = r'\s?(?:\[.*?\])?(.*?)(?:\[(.*)\])?\s?(?:\(([\d,]+)회\))?\s?(<재>)?$'
+            matches = re.match(pattern, cell[1].text.strip())
+            if matches:
+                programName = matches.group(1).strip() if matches.group(1) else ''
+                subprogramName = matches.group(2).strip() if matches.group(2) else ''
+                episode = matches.group(3) if matches.group(3) else ''
+                rebroadcast = True if matches.group(4) else False
+            else:
+                programName, subprogramName, episode, rebroadcast = '', '', '', False
+            category = cell[2].text.strip()
+            epginfo.append([ChannelInfo[0], startTime, programName, subprogramName, '', '', '', category, episode, rebroadcast, rating])
+        return epginfo
+
     for ChannelInfo in ChannelInfos:
+        if isDeadService('LG', ChannelInfo[3]):
+            log.debug('EPG 정보가 없는 채널로 기록되어 있습니다: %s', ChannelInfo)
+            continue
         epginfo = []
-        for k in range(period):
-            day = today + timedelta(days=k)
-            params.update({'chnlCd': ChannelInfo[3], 'evntCmpYmd': day.strftime('%Y%m%d')})
-            data = request_data(url, params, method='POST', output='html', session=sess)
+        for k in fetchDays(ChannelInfo[0]):
+            ymd = (today + timedelta(days=k)).strftime('%Y%m%d')
             try:
-                data = data.replace('<재>', '&lt;재&gt;').replace(' [..', '').replace(' (..', '')
-                soup = BeautifulSoup(data, htmlparser, parse_only=SoupStrainer('table'))
-                if not str(soup):
-                    log.warning('EPG 정보가 없거나 없는 채널입니다: %s' % ChannelInfo)
-                    # 오늘 없으면 내일도 없는 채널로 간주
-                    break
-                for row in soup.find('table').tbody.find_all('tr'):
-                    cell = row.find_all('td')
-                    startTime = str(day) + ' ' + cell[0].text
-                    startTime = datetime.strptime(startTime, '%Y-%m-%d %H:%M').strftime('%Y%m%d%H%M%S')
-                    rating_str = cell[1].find('span', {'class': 'tag cte_all'}).text.strip()
-                    rating = 0 if rating_str == 'All' else int(rating_str)
-                    cell[1].find('span', {'class': 'tagGroup'}).decompose()
-                    pattern = r'\s?(?:\[.*?\])?(.*?)(?:\[(.*)\])?\s?(?:\(([\d,]+)회\))?\s?(<재>)?$'
-                    matches = re.match(pattern, cell[1].text.strip())
-                    if matches:
-                        programName = matches.group(1).strip() if matches.group(1) else ''
-                        subprogramName = matches.group(2).strip() if matches.group(2) else ''
-                        episode = matches.group(3) if matches.group(3) else ''
-                        rebroadcast = True if matches.group(4) else False
-                    else:
-                        programName, subprogramName, episode, rebroadcast = '', '', '', False
-                    category = cell[2].text.strip()
-                    epginfo.append([ChannelInfo[0], startTime, programName, subprogramName, '', '', '', category, episode, rebroadcast, rating])
+                rows = checkpoint('LG', ChannelInfo[3], ymd, partial(get_programs, ChannelInfo, ymd))
+            except BudgetExceeded:
+                break
             except Exception as e:
-                log.error('파싱 에러: %s: %s' % (ChannelInfo, str(e)))
+                log.error('파싱 에러: %s: %s', ChannelInfo, str(e))
+                continue
+            if not rows:
+                if k > 0 or markDeadService('LG', ChannelInfo[3], 'EPG 없음'):
+                    log.warning('EPG 정보가 없거나 없는 채널입니다: %s', ChannelInfo)
+                # 오늘 없으면 내일도 없는 채널로 간주
+                break
+            epginfo.extend(rows)
+        if epginfo:
+            markAliveService('LG', ChannelInfo[3])
         epgzip(epginfo)
 
 
@@ -292,37 +720,56 @@ def GetEPGFromSK(ChannelInfos):
         all_services = [x['ServiceId'] for x in all_channels]
     except Exception as e:
         log.error('체널 목록을 가져오지 못했습니다: %s', str(e))
-        all_services = [x[3] for x in ChannelInfos]
+        all_services = None
 
     # remove unavailable channels in advance
     newChannelInfos = []
     for ChannelInfo in ChannelInfos:
-        ServiceId = ChannelInfo[3]
-        if ServiceId in all_services:
+        if availableService('SK', ChannelInfo[3], all_services, ChannelInfo):
             newChannelInfos.append(ChannelInfo)
-        else:
-            log.warning('없는 서비스 아이디입니다: %s', ChannelInfo)
 
     params = {
         'variable': 'IF_LIVECHART_DETAIL',
         'o_date': 'EPGDATE',
-        'svc_ids': '|'.join([info[3].strip() for info in newChannelInfos]),
+        'svc_ids': 'SVCIDS',
     }
 
-    for k in range(period):
-        day = today + timedelta(days=k)
-        params.update({'o_date': day.strftime('%Y%m%d')})
-        channels = {x['ID_SVC']: x['EventInfoArray'] for x in request_json(params)}
-
-        for ChannelInfo in newChannelInfos:
-            ServiceId = ChannelInfo[3]
-            if ServiceId in channels:
-                programs = channels[ServiceId]
+    def get_chunk(ymd, chunkInfos):
+        data = request_data(url, dict(params, o_date=ymd, svc_ids='|'.join([info[3].strip() for info in chunkInfos])),
+                            method='POST', output='json', session=sess)
+        if not data or data['result'].lower() != 'ok':
+            raise ValueError('유효한 응답이 아닙니다: %s' % (data['reason'] if data else '응답 없음'))
+        return data['ServiceInfoArray']
+
+    # 날짜마다 이 날까지 가져올 채널 중에서 작업 기록이나 재사용할 지난 결과에 없는 채널만
+    # sk_chunk_size개씩 묶어서 (날짜, 묶음) 단위로 동시에 요청
+    tasks = []
+    for k in fetchDays(*[info[0] for info in newChannelInfos]):
+        ymd = (today + timedelta(days=k)).strftime('%Y%m%d')
+        missing = []
+        for ChannelInfo in [info for info in newChannelInfos if k < depthOf(info[0])]:
+            programs = cached('SK', ChannelInfo[3], ymd)
+            if programs is not None:
+                writeSKPrograms(ChannelInfo, programs)
+            else:
+                missing.append(ChannelInfo)
+        for i in range(0, len(missing), sk_chunk_size):
+            tasks.append((ymd, missing[i:i + sk_chunk_size]))
+
+    # 끝나는 대로 바로 기록하고 프로그램을 만든다
+    for (ymd, chunkInfos), services in fetchParallel(tasks, get_chunk):
+        channels = {}
+        for x in services or []:
+            channels[x['ID_SVC']] = x['EventInfoArray']
+            remember('SK', x['ID_SVC'], ymd, x['EventInfoArray'])
+        for ChannelInfo in chunkInfos:
+            programs = channels.get(ChannelInfo[3])
+            if programs is not None:
                 writeSKPrograms(ChannelInfo, programs)
             else:
-                log.warning('해당 날짜에 EPG 정보가 없거나 없는 채널입니다: %s %s' % (day.strftime('%Y%m%d'), ChannelInfo))
+                log.warning('해당 날짜에 EPG 정보가 없거나 없는 채널입니다: %s %s', ymd, ChannelInfo)
 
-    log.info('SK EPG 완료: {}/{}개 채널'.format(len(newChannelInfos), len(ChannelInfos)))
+    log.info('SK EPG 완료: %s/%s개 채널', len(newChannelInfos), len(ChannelInfos))
 
 
 def GetEPGFromSKB(ChannelInfos):
@@ -361,67 +808,76 @@ def GetEPGFromSKB(ChannelInfos):
         all_services = [x['ServiceId'] for x in all_channels]
     except Exception as e:
         log.error('체널 목록을 가져오지 못했습니다: %s', str(e))
-        all_services = [x[3] for x in ChannelInfos]
+        all_services = None
+
+    def get_programs(ChannelInfo, ymd):
+        data = request_data(url, dict(params, key_depth2=ChannelInfo[3], key_depth3=ymd), method='GET', output='html', session=sess)
+        if not data:
+            raise ValueError('응답이 없습니다')
+        epginfo = []
+        data = re.sub('EUC-KR', 'utf-8', data)
+        data = re.sub('<!--(.*?)-->', '', data, 0, re.I | re.S)
+        data = re.sub('<span class="round_flag flag02">(.*?)</span>', '', data)
+        data = re.sub('<span class="round_flag flag03">(.*?)</span>', '', data)
+        data = re.sub('<span class="round_flag flag04">(.*?)</span>', '', data)
+        data = re.sub('<span class="round_flag flag09">(.*?)</span>', '', data)
+        data = re.sub('<span class="round_flag flag10">(.*?)</span>', '', data)
+        data = re.sub('<span class="round_flag flag11">(.*?)</span>', '', data)
+        data = re.sub('<span class="round_flag flag12">(.*?)</span>', '', data)
+        data = re.sub('<strong class="hide">프로그램 안내</strong>', '', data)
+        data = re.sub('<p class="cont">(.*)', partial(replacement, tag='p'), data)
+        data = re.sub('<p class="tit">(.*)', partial(replacement, tag='p'), data)
+        strainer = SoupStrainer('div', {'id': 'uiScheduleTabContent'})
+        soup = BeautifulSoup(data, htmlparser, parse_only=strainer)
+        html = soup.find_all('li', {'class': 'list'}) if soup.find_all('li') else ''
+        for row in html:
+            startTime = programName = subprogramName = episode = ''
+            rebroadcast = False
+            rating = 0
+            startTime = epgtime(ymd, row.find('p', {'class': 'time'}).text)
+            cell = row.find('p', {'class': 'cont'})
+            grade = row.find('i', {'class': 'hide'})
+            if grade is not None:
+                rating = int(grade.text.replace('세 이상', '').strip())
+
+            if cell:
+                if cell.find('span'):
+                    cell.span.decompose()
+                cell = cell.text.strip()
+                pattern = "^(.*?)(\(([\d,]+)회\))?(<(.*)>)?(\((재)\))?$"
+                matches = re.match(pattern, cell)
+
+                if matches:
+                    programName = matches.group(1) if matches.group(1) else ''
+                    subprogramName = matches.group(5) if matches.group(5) else ''
+                    rebroadcast = True if matches.group(7) else False
+                    episode = matches.group(3) if matches.group(3) else ''
+
+            epginfo.append([ChannelInfo[0], startTime, programName, subprogramName, '', '', '', '', episode, rebroadcast, rating])
+        return epginfo
 
     for ChannelInfo in ChannelInfos:
-        if ChannelInfo[3] not in all_services:
-            log.warning('없는 서비스 아이디입니다: %s', ChannelInfo)
+        if not availableService('SKB', ChannelInfo[3], all_services, ChannelInfo):
             continue
         epginfo = []
-        for k in range(period):
-            day = today + timedelta(days=k)
-            params.update({'key_depth2': ChannelInfo[3], 'key_depth3': day.strftime('%Y%m%d')})
-            data = request_data(url, params, method='GET', output='html', session=sess)
+        for k in fetchDays(ChannelInfo[0]):
+            ymd = (today + timedelta(days=k)).strftime('%Y%m%d')
             try:
-                data = re.sub('EUC-KR', 'utf-8', data)
-                data = re.sub('<!--(.*?)-->', '', data, 0, re.I | re.S)
-                data = re.sub('<span class="round_flag flag02">(.*?)</span>', '', data)
-                data = re.sub('<span class="round_flag flag03">(.*?)</span>', '', data)
-                data = re.sub('<span class="round_flag flag04">(.*?)</span>', '', data)
-                data = re.sub('<span class="round_flag flag09">(.*?)</span>', '', data)
-                data = re.sub('<span class="round_flag flag10">(.*?)</span>', '', data)
-                data = re.sub('<span class="round_flag flag11">(.*?)</span>', '', data)
-                data = re.sub('<span class="round_flag flag12">(.*?)</span>', '', data)
-                data = re.sub('<strong class="hide">프로그램 안내</strong>', '', data)
-                data = re.sub('<p class="cont">(.*)', partial(replacement, tag='p'), data)
-                data = re.sub('<p class="tit">(.*)', partial(replacement, tag='p'), data)
-                strainer = SoupStrainer('div', {'id': 'uiScheduleTabContent'})
-                soup = BeautifulSoup(data, htmlparser, parse_only=strainer)
-                html = soup.find_all('li', {'class': 'list'}) if soup.find_all('li') else ''
-                if html:
-                    for row in html:
-                        startTime = endTime = programName = subprogramName = episode = ''
-                        rebroadcast = False
-                        rating = 0
-                        startTime = str(day) + ' ' + row.find('p', {'class': 'time'}).text
-                        startTime = datetime.strptime(startTime, '%Y-%m-%d %H:%M')
-                        startTime = startTime.strftime('%Y%m%d%H%M%S')
-                        cell = row.find('p', {'class': 'cont'})
-                        grade = row.find('i', {'class': 'hide'})
-                        if grade is not None:
-                            rating = int(grade.text.replace('세 이상', '').strip())
-
-                        if cell:
-                            if cell.find('span'):
-                                cell.span.decompose()
-                            cell = cell.text.strip()
-                            pattern = "^(.*?)(\(([\d,]+)회\))?(<(.*)>)?(\((재)\))?$"
-                            matches = re.match(pattern, cell)
-
-                            if matches:
-                                programName = matches.group(1) if matches.group(1) else ''
-                                subprogramName = matches.group(5) if matches.group(5) else ''
-                                rebroadcast = True if matches.group(7) else False
-                                episode = matches.group(3) if matches.group(3) else ''
-
-                        epginfo.append([ChannelInfo[0], startTime, programName, subprogramName, '', '', '', '', episode, rebroadcast, rating])
-                else:
-                    log.warning('EPG 정보가 없거나 없는 채널입니다: %s' % ChannelInfo)
-                    # 오늘 없으면 내일도 없는 채널로 간주
-                    break
+                rows = checkpoint('SKB', ChannelInfo[3], ymd, partial(get_programs, ChannelInfo, ymd))
+            except BudgetExceeded:
+                break
             except Exception as e:
-                log.error('파싱 에러: %s: %s' % (ChannelInfo, str(e)))
-            epgzip(epginfo)
+                log.error('파싱 에러: %s: %s', ChannelInfo, str(e))
+                continue
+            if not rows:
+                if k > 0 or markDeadService('SKB', ChannelInfo[3], 'EPG 없음'):
+                    log.warning('EPG 정보가 없거나 없는 채널입니다: %s', ChannelInfo)
+                # 오늘 없으면 내일도 없는 채널로 간주
+                break
+            epginfo.extend(rows)
+        if epginfo:
+            markAliveService('SKB', ChannelInfo[3])
+        epgzip(epginfo)
 
 
 def GetEPGFromNaver(ChannelInfos):
@@ -443,32 +899,35 @@ def GetEPGFromNaver(ChannelInfos):
     sess = requests.session()
     sess.headers.update({'User-Agent': ua, 'Referer': referer})
 
+    def get_programs(ChannelInfo, ymd):
+        data = request_data(url, dict(params, u1=ChannelInfo[3], u2=ymd), method='GET', output='json', session=sess)
+        if data['statusCode'].lower() != 'success':
+            raise ValueError('유효한 응답이 아닙니다: %s' % data['statusCode'])
+        epginfo = []
+        soup = BeautifulSoup(''.join(data['dataHtml']), htmlparser)
+        for row in soup.find_all('li', {'class': 'list'}):
+            cell = row.find_all('div')
+            rating = 0
+            programName = unescape(cell[4].text.strip())
+            startTime = epgtime(ymd, cell[1].text.strip())
+            rebroadcast = True if cell[3].find('span', {'class': 're'}) else False
+            try:
+                subprogramName = cell[5].text.strip()
+            except:
+                subprogramName = ''
+            epginfo.append([ChannelInfo[0], startTime, programName, subprogramName, '', '', '', '', '', rebroadcast, rating])
+        return epginfo
+
     for ChannelInfo in ChannelInfos:
         epginfo = []
-        for k in range(period):
-            day = today + timedelta(days=k)
-            params.update({'u1': ChannelInfo[3], 'u2': day.strftime('%Y%m%d')})
-            data = request_data(url, params, method='GET', output='json', session=sess)
+        for k in fetchDays(ChannelInfo[0]):
+            ymd = (today + timedelta(days=k)).strftime('%Y%m%d')
             try:
-                if data['statusCode'].lower() != 'success':
-                    log.error('유효한 응답이 아닙니다: %s %s' % (ChannelInfo, data['statusCode']))
-                    continue
-
-                soup = BeautifulSoup(''.join(data['dataHtml']), htmlparser)
-                for row in soup.find_all('li', {'class': 'list'}):
-                    cell = row.find_all('div')
-                    rating = 0
-                    programName = unescape(cell[4].text.strip())
-                    startTime = str(day) + ' ' + cell[1].text.strip()
-                    startTime = datetime.strptime(startTime, '%Y-%m-%d %H:%M').strftime('%Y%m%d%H%M%S')
-                    rebroadcast = True if cell[3].find('span', {'class': 're'}) else False
-                    try:
-                        subprogramName = cell[5].text.strip()
-                    except:
-                        subprogramName = ''
-                    epginfo.append([ChannelInfo[0], startTime, programName, subprogramName, '', '', '', '', '', rebroadcast, rating])
+                epginfo.extend(checkpoint('NAVER', ChannelInfo[3], ymd, partial(get_programs, ChannelInfo, ymd)))
+            except BudgetExceeded:
+                break
             except Exception as e:
-                log.error('파싱 에러: %s: %s' % (ChannelInfo, str(e)))
+                log.error('파싱 에러: %s: %s', ChannelInfo, str(e))
         epgzip(epginfo)
 
 
@@ -505,43 +964,102 @@ def GetEPGFromWAVVE(reqChannels):
     sess = requests.session()
     sess.headers.update({'User-Agent': ua, 'Referer': referer})
 
-    # update parameters for requests
-    params.update({
-        'startdatetime': today.strftime('%Y-%m-%d') + ' 00:00',
-        'enddatetime': (today + timedelta(days=period-1)).strftime('%Y-%m-%d') + ' 24:00',
-    })
-
-    channellist = request_data(url, params, method='GET', output='json', session=sess)['list']
-    channeldict = {x['channelid']: x for x in channellist}
-
-    # dump all available channels to json
-    all_channels = [{
-        'WAVVE Name': x['channelname'],
-        'Icon_url': 'https://' + x['channelimage'],
-        'Source': 'WAVVE',
-        'ServiceId': x['channelid']
-    } for x in channellist]
-    dump_channels('WAVVE', all_channels)
+    # update parameters for requests: 가장 오래 가져올 채널에 맞추고 wavve_daily이면 날마다 따로 요청
+    days = fetchDays(*[c.get('Id') for c in reqChannels])
+    if not days:
+        return
+    dates = [today + timedelta(days=k) for k in days]
+    ranges = [(x, x) for x in dates] if wavve_daily else [(dates[0], dates[-1])]
+    wanted = set(x['ServiceId'] for x in reqChannels if 'ServiceId' in x)
+    limit = params['limit']
+
+    # 요청하지 않은 채널의 프로그램은 버리고 저장하므로 작업 단위에 요청한 채널 목록의 해시를 넣는다
+    wanted_key = servicesKey(wanted)
+
+    def unit(offset, start, end):
+        # 작업 단위: (소스, 'offset|페이지 시작|채널 목록 해시', 날짜 또는 날짜 범위)
+        return 'offset|%s|%s' % (offset, wanted_key), start.strftime('%Y%m%d') + ('' if start == end else '-' + end.strftime('%Y%m%d'))
+
+    def get_page(offset, start, end):
+        # 여러 날짜의 전체 채널 응답은 매우 크므로 요청하지 않은 채널의 프로그램은 버린다
+        # 페이지는 모두 채널 단위로 읽으면서 첫 페이지에서는 전체 채널 수(pagecount)도 알아낸다
+        page_params = dict(params, offset=offset,
+                           startdatetime=start.strftime('%Y-%m-%d') + ' 00:00',
+                           enddatetime=end.strftime('%Y-%m-%d') + ' 24:00')
+        values = {}
+        channels = []
+        for x in request_items(url, page_params, 'list.item', session=sess, values=values):
+            if x['channelid'] not in wanted:
+                x['list'] = []
+            channels.append(x)
+        return {'total': int(values['pagecount']) if offset == 0 else None, 'list': channels}
+
+    # 채널별로 페이지와 날짜의 프로그램을 이어 붙인다
+    channeldict = OrderedDict()
+
+    def fetch_pages(tasks):
+        # 작업 기록이나 재사용할 지난 결과에 없는 페이지만 동시에 요청해서 끝나는 대로 합친다
+        missing = []
+        pages = []
+        for task in tasks:
+            page = cached('WAVVE', *unit(*task))
+            if page is None:
+                missing.append(task)
+            else:
+                pages.append((task, page))
+        for task, page in chain(pages, fetchParallel(missing, get_page, budgeted=False)):
+            if page is None:
+                continue
+            if task in missing:
+                remember('WAVVE', *unit(*task), page)
+            for x in page['list']:
+                if x['channelid'] in channeldict:
+                    channeldict[x['channelid']]['list'].extend(x['list'])
+                else:
+                    channeldict[x['channelid']] = dict(x, list=list(x['list']))
+            yield task, page
+
+    # 기간마다 첫 페이지를 가져온 뒤 나머지 페이지를 한꺼번에
+    tasks = [(0, start, end) for start, end in ranges]
+    first_pages = list(fetch_pages(tasks))
+    # 전체 채널 수는 기간과 상관없으므로 첫 페이지를 못 가져온 기간도 나머지 페이지는 가져온다
+    total = max([page['total'] for task, page in first_pages] or [0])
+    rest = [(x, start, end) for start, end in ranges for x in range(limit, total, limit)]
+    rest_pages = list(fetch_pages(rest))
+    complete = len(first_pages) == len(tasks) and len(rest_pages) == len(rest)
+    if not channeldict:
+        log.error('WAVVE 채널 목록을 가져오지 못했습니다.')
+        return
 
-    # remove unavailable channels in advance
-    all_services = [x['channelid'] for x in channellist]
+    # dump all available channels to json (못 가져온 페이지가 있으면 --plan이 읽는 전체 채널 수가 틀리므로 쓰지 않는다)
+    if complete:
+        all_channels = [{
+            'WAVVE Name': x['channelname'],
+            'Icon_url': 'https://' + x['channelimage'],
+            'Source': 'WAVVE',
+            'ServiceId': x['channelid']
+        } for x in channeldict.values()]
+        dump_channels('WAVVE', all_channels)
+
+    # remove unavailable channels in advance (못 가져온 페이지가 있으면 없는 채널 기록만 참고)
+    all_services = list(channeldict) if complete else None
     tmpChannels = []
     for reqChannel in reqChannels:
-        if reqChannel['ServiceId'] in all_services:
+        if availableService(reqChannel['Source'], reqChannel['ServiceId'], all_services, reqChannel):
             tmpChannels.append(reqChannel)
-        else:
-            log.warning('없는 서비스 아이디입니다: %s', reqChannel)
 
     # reqChannels = all_channels  # request all channels
     reqChannels = tmpChannels
 
-    # for caching program details
-    programcache = {}
+    # for caching program details (--progressive에서 두 번 호출되어도 한 번만 가져오도록 전역)
+    programcache = WAVVEProgramCache
+    debug = log.isEnabledFor(logging.DEBUG)
+    details = 0
 
     try:
         for reqChannel in reqChannels:
             if not ('ServiceId' in reqChannel and reqChannel['ServiceId'] in channeldict):
-                log.warning('EPG 정보가 없거나 없는 채널입니다: %s' % reqChannel)
+                log.warning('EPG 정보가 없거나 없는 채널입니다: %s', reqChannel)
                 continue
 
             # 채널이름은 그대로 들어오고 프로그램 제목은 escape되어 들어옴
@@ -550,16 +1068,14 @@ def GetEPGFromWAVVE(reqChannels):
             channelname = reqChannel['Name'] if 'Name' in reqChannel else srcChannel['channelname'].strip()
             channelicon = reqChannel['Icon_url'] if 'Icon_url' in reqChannel else 'https://' + srcChannel['channelimage']
             # channelliveimg = "https://wchimg.pooq.co.kr/pooqlive/thumbnail/%s.jpg" % reqChannel['ServiceId']
-            print('  <channel id="%s">' % channelid)
-            print('    <icon src="%s" />' % escape(channelicon))
-            print('    <display-name>%s</display-name>' % escape(channelname))
-            print('  </channel>')
+            addChannel({'Id': channelid, 'Name': channelname, 'Icon_url': channelicon, 'Source': 'WAVVE'})
 
             for program in srcChannel['list']:
                 try:
-                    log.debug('{}/{}'.format(channelname, program['title']))
-                    startTime = datetime.strptime(program['starttime'], '%Y-%m-%d %H:%M').strftime('%Y%m%d%H%M%S')
-                    endTime = datetime.strptime(program['endtime'], '%Y-%m-%d %H:%M').strftime('%Y%m%d%H%M%S')
+                    if debug:
+                        log.debug('%s/%s', channelname, program['title'])
+                    startTime = epgdatetime(program['starttime'])
+                    endTime = epgdatetime(program['endtime'])
 
                     # TODO: 제목 너무 지저분/부실하네
                     # TODO: python3에서 re.match에 더 많이 잡힘. 왜?
@@ -582,7 +1098,11 @@ def GetEPGFromWAVVE(reqChannels):
                     programid = program['programid'].strip()
                     if programid and (programid not in programcache):
                         # 개별 programid가 없는 경우도 있으니 체크해야함
-                        programdetail = getWAVVEProgramDetails(programid, sess)
+                        details += 1
+                        try:
+                            programdetail = checkpoint('WAVVE', 'programid|' + programid, '', partial(getWAVVEProgramDetails, programid, sess))
+                        except BudgetExceeded:
+                            programdetail = None
                         if programdetail is not None:
                             programdetail[u'hit'] = 0  # to know cache hit rate
                         programcache[programid] = programdetail
@@ -600,7 +1120,7 @@ def GetEPGFromWAVVE(reqChannels):
                         if programdetail['actors']['list']:
                             actors = ','.join([x['text'] for x in programdetail['actors']['list']])
 
-                    writeProgram({
+                    addProgram({
                         'channelId': channelid,
                         'startTime': startTime,
                         'endTime': endTime,
@@ -616,11 +1136,14 @@ def GetEPGFromWAVVE(reqChannels):
                         'iconurl': iconurl
                     })
                 except Exception as e:
-                    log.error('파싱 에러: %s' % str(e))
-                    log.error(program)
-        log.info('WAVVE EPG 완료: {}개 채널'.format(len(reqChannels)))
+                    log.error('파싱 에러: %s', str(e))
+                    log.error('%s', program)
+        log.info('WAVVE EPG 완료: %s개 채널', len(reqChannels))
     except Exception as e:
         log.error(str(e))
+    # --plan에서 상세 정보 요청 수를 추정하도록 채널/일당 처음 본 프로그램 수를 기록
+    add_stat('WAVVE|details', details)
+    add_stat('WAVVE|channel-days', len(reqChannels) * len(days))
 
 
 def getWAVVEProgramDetails(programid, sess):
@@ -735,44 +1258,52 @@ def GetEPGFromTVING(reqChannels):
     all_services = [x['channel_code'] for x in channellist]
     tmpChannels = []
     for reqChannel in reqChannels:
-        if reqChannel['ServiceId'] in all_services:
+        if availableService(reqChannel['Source'], reqChannel['ServiceId'], all_services, reqChannel):
             tmpChannels.append(reqChannel)
-        else:
-            log.warning('없는 서비스 아이디입니다: %s', reqChannel)
 
     # reqChannels = all_channels  # request all channels
     reqChannels = tmpChannels
 
     params.update({"channelCode": ','.join([x['ServiceId'].strip() for x in reqChannels])})
 
-    channeldict = {}
-    for k in range(period):
-        day = today + timedelta(days=k)
-        params.update({'broadDate': day.strftime('%Y%m%d'), 'broadcastDate': day.strftime('%Y%m%d')})
+    def get_day(ymd):
+        day_params = dict(params, broadDate=ymd, broadcastDate=ymd)
+        results = []
         for t in range(8):
-            params.update({
+            day_params.update({
                 "startBroadTime": '{:02d}'.format(t*3) + "0000",
                 "endBroadTime": '{:02d}'.format(t*3+3) + "0000",
             })
-            for ch in get_json(params):
-                if ch['channel_code'] in channeldict:
-                    if ch['schedules']:
-                        channeldict[ch['channel_code']]['schedules'] += ch['schedules']
-                else:
-                    channeldict[ch['channel_code']] = ch
+            results.extend(get_json(day_params))
+        return results
+
+    # 요청한 채널 목록에 따라 응답이 다르므로 작업 단위에 채널 목록의 해시를 넣는다
+    unit = '*|' + servicesKey(x['ServiceId'].strip() for x in reqChannels)
+    channeldict = {}
+    for k in fetchDays(*[c.get('Id') for c in reqChannels]):
+        ymd = (today + timedelta(days=k)).strftime('%Y%m%d')
+        try:
+            channels = checkpoint('TVING', unit, ymd, partial(get_day, ymd), budgeted=False)
+        except Exception as e:
+            log.error('파싱 에러: %s: %s', ymd, str(e))
+            continue
+        for ch in channels:
+            if ch['channel_code'] in channeldict:
+                if ch['schedules']:
+                    channeldict[ch['channel_code']]['schedules'] += ch['schedules']
+            else:
+                ch['schedules'] = ch['schedules'] or []
+                channeldict[ch['channel_code']] = ch
 
     for reqChannel in reqChannels:
         if not ('ServiceId' in reqChannel and reqChannel['ServiceId'] in channeldict):
-            log.warning('EPG 정보가 없거나 없는 채널입니다: %s' % reqChannel)
+            log.warning('EPG 정보가 없거나 없는 채널입니다: %s', reqChannel)
             continue
         srcChannel = channeldict[reqChannel['ServiceId']]
         channelid = reqChannel['Id'] if 'Id' in reqChannel else 'tving|%s' % srcChannel['channel_code']
         channelname = reqChannel['Name'] if 'Name' in reqChannel else srcChannel['channel_name']['ko'].strip()
         channelicon = reqChannel['Icon_url'] if 'Icon_url' in reqChannel else get_imgurl(srcChannel)
-        print('  <channel id="%s">' % channelid)
-        print('    <icon src="%s" />' % escape(channelicon))
-        print('    <display-name>%s</display-name>' % escape(channelname))
-        print('  </channel>')
+        addChannel({'Id': channelid, 'Name': channelname, 'Icon_url': channelicon, 'Source': 'TVING'})
 
         for sch in srcChannel['schedules']:
             # 공통
@@ -805,7 +1336,7 @@ def GetEPGFromTVING(reqChannels):
                 episode = '' if episode == 0 else str(episode)
                 desc = sch['episode']['synopsis']['ko']
 
-            writeProgram({
+            addProgram({
                 'channelId': channelid,
                 'startTime': startTime,
                 'endTime': endTime,
@@ -820,151 +1351,267 @@ def GetEPGFromTVING(reqChannels):
                 'rating': rating,
                 'iconurl': iconurl
             })
-    log.info('TVING EPG 완료: {}개 채널'.format(len(reqChannels)))
+    log.info('TVING EPG 완료: %s개 채널', len(reqChannels))
+
+
+def isDeadService(source, ServiceId):
+    """없는 채널로 기록되어 있고 다시 확인할 때가 안 되었으면 True"""
+    entry = DeadServices.get('%s|%s' % (source, ServiceId))
+    return bool(entry) and dead_days > 0 and entry['expires'] > datetime.now().strftime('%Y/%m/%d %H:%M:%S')
+
+
+def markDeadService(source, ServiceId, reason):
+    """없는 채널로 기록하고 새로 기록되었으면 True"""
+    key = '%s|%s' % (source, ServiceId)
+    now = datetime.now()
+    entry = DeadServices.setdefault(key, {
+        'Source': source,
+        'ServiceId': ServiceId,
+        'reason': reason,
+        'since': now.strftime('%Y/%m/%d %H:%M:%S'),
+    })
+    entry.update({
+        'checked': now.strftime('%Y/%m/%d %H:%M:%S'),
+        'expires': (now + timedelta(days=dead_days)).strftime('%Y/%m/%d %H:%M:%S'),
+    })
+    return entry['since'] == entry['checked']
+
+
+def markAliveService(source, ServiceId, reason=None):
+    """EPG를 다시 찾은 채널을 기록에서 지운다. reason을 주면 그 이유로 기록된 것만"""
+    key = '%s|%s' % (source, ServiceId)
+    if key in DeadServices and (reason is None or DeadServices[key]['reason'] == reason):
+        log.info('없는 채널 기록에서 지웁니다: %s', DeadServices.pop(key))
+
+
+def availableService(source, ServiceId, all_services, info):
+    """소스의 채널 목록(all_services)으로 확인하고 없는 채널 기록을 갱신한다"""
+    if not all_services:
+        # 채널 목록을 가져오지 못했으면 기록만 참고
+        return not isDeadService(source, ServiceId)
+    if ServiceId in all_services:
+        markAliveService(source, ServiceId, '없는 서비스 아이디')
+        return not isDeadService(source, ServiceId)
+    if markDeadService(source, ServiceId, '없는 서비스 아이디'):
+        log.warning('없는 서비스 아이디입니다: %s', info)
+    else:
+        log.debug('없는 서비스 아이디입니다: %s', info)
+    return False
+
+
+def saveDeadServices():
+    if dead_days > 0:
+        dump_json(args['deadfile'], sorted(DeadServices.values(), key=lambda x: (x['Source'], x['ServiceId'])))
+
+
+def reportDeadServices():
+    if not DeadServices:
+        return
+    ids = {}
+    for c in Channeldatajson:
+        if 'Id' in c:
+            ids.setdefault('%s|%s' % (c['Source'], c['ServiceId']), []).append(c['Id'])
+    log.info('EPG가 없는 채널로 기록된 서비스 %s개 (Channel.json 정리 대상):', len(DeadServices))
+    for key, entry in sorted(DeadServices.items()):
+        log.info('  %s %s Id=%s 이유=%s 처음=%s 확인=%s', entry['Source'], entry['ServiceId'],
+                 ids.get(key, []), entry['reason'], entry['since'], entry['checked'])
 
 
 def epgzip(epginfo):
     # ChannelId, startTime, programName, subprogramName, desc, actors, producers, category, episode, rebroadcast, rating
-    if epginfo:
-        epginfo = iter(epginfo)
-        epg1 = next(epginfo)
-        for epg2 in epginfo:
-            ChannelId = epg1[0]
-            startTime = epg1[1] if epg1[1] else ''
-            endTime = epg2[1] if epg2[1] else ''
-            programName = epg1[2] if epg1[2] else ''
-            subprogramName = epg1[3] if epg1[3] else ''
-            desc = epg1[4] if epg1[4] else ''
-            actors = epg1[5] if epg1[5] else ''
-            producers = epg1[6] if epg1[6] else ''
-            category = epg1[7] if epg1[7] else ''
-            episode = epg1[8] if epg1[8] else ''
-            rebroadcast = True if epg1[9] else False
-            rating = int(epg1[10]) if epg1[10] else 0
-            writeProgram({
-                'channelId': ChannelId,
-                'startTime': startTime,
-                'endTime': endTime,
-                'programName': programName,
-                'subprogramName': subprogramName,
-                'desc': desc,
-                'actors': actors,
-                'producers': producers,
-                'category': category,
-                'episode': episode,
-                'rebroadcast': rebroadcast,
-                'rating': rating
-            })
-            epg1 = epg2
+    # 종료 시간은 buildTimeline()에서 다음 프로그램의 시작 시간으로 채운다
+    for epg in epginfo:
+        addProgram({
+            'channelId': epg[0],
+            'startTime': epg[1] if epg[1] else '',
+            'endTime': '',
+            'programName': epg[2] if epg[2] else '',
+            'subprogramName': epg[3] if epg[3] else '',
+            'desc': epg[4] if epg[4] else '',
+            'actors': epg[5] if epg[5] else '',
+            'producers': epg[6] if epg[6] else '',
+            'category': epg[7] if epg[7] else '',
+            'episode': epg[8] if epg[8] else '',
+            'rebroadcast': True if epg[9] else False,
+            'rating': int(epg[10]) if epg[10] else 0
+        })
+
+
+def buildTimeline(programs):
+    """한 채널의 프로그램을 시작 시간 순으로 정렬하고 중복과 겹침을 정리한다
+
+    - 시작 시간이 같으면 중복으로 보고 앞의 것에 빠진 정보만 채운다
+    - 종료 시간이 없거나 다음 프로그램과 겹치면 다음 프로그램의 시작 시간에서 끝낸다
+    - 마지막 프로그램은 종료 시간을 알 수 없으면 버린다
+    """
+    timeline = []
+    for programdata in sorted(programs, key=lambda x: x['startTime']):
+        if not programdata['startTime'] or (programdata['endTime'] and programdata['endTime'] <= programdata['startTime']):
+            log.debug('잘못된 시간입니다: %s', programdata)
+            continue
+        if timeline:
+            prev = timeline[-1]
+            if prev['startTime'] == programdata['startTime']:
+                for k, v in programdata.items():
+                    if v and not prev.get(k):
+                        prev[k] = v
+                continue
+            if not prev['endTime'] or prev['endTime'] > programdata['startTime']:
+                prev['endTime'] = programdata['startTime']
+        timeline.append(programdata)
+    if timeline and not timeline[-1]['endTime']:
+        timeline.pop()
+    return timeline
+
+
+# 장르 -> XMLTV 영문 장르 (여러 개가 맞으면 뒤의 것)
+content_types = [
+    ('교양', 'Arts / Culture (without music)'),
+    ('만화', 'Cartoons / Puppets'),
+    ('교육', 'Education / Science / Factual topics'),
+    ('취미', 'Leisure hobbies'),
+    ('드라마', 'Movie / Drama'),
+    ('영화', 'Movie / Drama'),
+    ('음악', 'Music / Ballet / Dance'),
+    ('뉴스', 'News / Current affairs'),
+    ('다큐', 'Documentary'),
+    ('라이프', 'Documentary'),
+    ('시사/다큐', 'Documentary'),
+    ('연예', 'Show / Game show'),
+    ('스포츠', 'Sports'),
+    ('홈쇼핑', 'Advertisement / Shopping'),
+]
+part_pattern = re.compile(r'(.*) \(?(\d+부)\)?')
+spaces_pattern = re.compile(' +')
+
+# 카테고리, 출연자, 제목처럼 반복되는 값은 한 번만 가공한다
+escapeText = lru_cache(maxsize=65536)(escape)
+squeeze = lru_cache(maxsize=65536)(partial(spaces_pattern.sub, ' '))
+
+
+@lru_cache(maxsize=None)
+def contentTypeOf(category):
+    contentType = ''
+    for key, value in content_types:
+        if key in category:
+            contentType = value
+    return contentType
+
 
+@lru_cache(maxsize=16384)
+def splitNames(names):
+    # 'a, b,c' -> desc용 문자열, <credits>용 이름 목록
+    names = escapeText(names)
+    return squeeze(names.strip()), tuple(x.strip() for x in names.split(',') if x.strip())
 
-def writeProgram(programdata):
-    ChannelId = programdata['channelId']
-    startTime = programdata['startTime']
-    endTime = programdata['endTime']
-    programName = escape(programdata['programName']).strip()
-    subprogramName = escape(programdata['subprogramName']).strip()
-    matches = re.match('(.*) \(?(\d+부)\)?', unescape(programName))
+
+def addProgram(programdata):
+    """프로그램 정보를 정리하고 이스케이프해서 저장한다. 출력할 때는 다시 가공하지 않는다."""
+    programName = programdata['programName'].strip()
+    subprogramName = escapeText(programdata['subprogramName']).strip()
+    matches = part_pattern.match(programName)
     if matches:
-        programName = escape(matches.group(1)).strip()
-        subprogramName = escape(matches.group(2)) + ' ' + subprogramName
-        subprogramName = subprogramName.strip()
-    if programName is None:
-        programName = subprogramName
-    actors = escape(programdata['actors'])
-    producers = escape(programdata['producers'])
-    category = escape(programdata['category'])
-    episode = programdata['episode']
+        programName = matches.group(1).strip()
+        subprogramName = (escapeText(matches.group(2)) + ' ' + subprogramName).strip()
+    episode = str(programdata['episode']) if programdata['episode'] else ''
+    episode_ns = ''
     if episode:
         try:
             episode_ns = int(episode) - 1
         except ValueError:
             episode_ns = int(episode.split(',', 1)[0]) - 1
         episode_ns = '0' + '.' + str(episode_ns) + '.' + '0' + '/' + '0'
-        episode_on = episode
+    actors, actorList = splitNames(programdata['actors'])
+    producers, producerList = splitNames(programdata['producers'])
+    category = escapeText(programdata['category'].strip())
+    desc = programdata['desc']
+    EPGPrograms.setdefault(programdata['channelId'], []).append({
+        'channelId': programdata['channelId'],
+        'startTime': programdata['startTime'],
+        'endTime': programdata['endTime'],
+        'programName': escapeText(programName),
+        'subprogramName': subprogramName,
+        'desc': spaces_pattern.sub(' ', escape(desc)) if desc else '',
+        'actors': actors,
+        'actorList': actorList,
+        'producers': producers,
+        'producerList': producerList,
+        'category': category,
+        'contentType': contentTypeOf(category),
+        'episode': episode,
+        'episode_ns': episode_ns,
+        'rebroadcast': programdata['rebroadcast'],
+        'rating': programdata['rating'],
+        'iconurl': escape(programdata['iconurl']) if programdata.get('iconurl') else '',
+    })
+
+
+def writeProgram(programdata, profile):
+    # programdata는 addProgram()에서 이미 이스케이프되어 있음
+    programName = programdata['programName']
+    subprogramName = programdata['subprogramName']
+    category = programdata['category']
+    episode = programdata['episode']
     rebroadcast = programdata['rebroadcast']
-    if episode and addepisode == 'y':
-        programName = programName + ' (' + str(episode) + '회)'
-    if rebroadcast and (addrebroadcast == 'y'):
-        programName = programName + ' (재)'
+    suffix = ''
+    if episode and profile['addepisode'] == 'y':
+        suffix += ' (' + episode + '회)'
+    if rebroadcast and (profile['addrebroadcast'] == 'y'):
+        suffix += ' (재)'
     if programdata['rating'] == 0:
         rating = '전체 관람가'
     else:
         rating = '%s세 이상 관람가' % (programdata['rating'])
-    if addverbose == 'y':
-        desc = programName
+
+    lines = [
+        '  <programme start="%s +0900" stop="%s +0900" channel="%s">' % (programdata['startTime'], programdata['endTime'], programdata['channelId']),
+        '    <title lang="kr">%s</title>' % (programName + suffix),
+    ]
+    if subprogramName:
+        lines.append('    <sub-title lang="kr">%s</sub-title>' % subprogramName)
+    if profile['addverbose'] == 'y':
+        desc = [squeeze(programName) + suffix]
         if subprogramName:
-            desc += '\n부제 : ' + subprogramName
-        if rebroadcast and (addrebroadcast == 'y'):
-            desc += '\n방송 : 재방송'
+            desc.append('부제 : ' + squeeze(subprogramName))
+        if rebroadcast and (profile['addrebroadcast'] == 'y'):
+            desc.append('방송 : 재방송')
         if episode:
-            desc += '\n회차 : ' + str(episode) + '회'
+            desc.append('회차 : ' + episode + '회')
         if category:
-            desc += '\n장르 : ' + category
-        if actors:
-            desc += '\n출연 : ' + actors.strip()
-        if producers:
-            desc += '\n제작 : ' + producers.strip()
-        desc += '\n등급 : ' + rating
-    else:
-        desc = ''
-    if programdata['desc']:
-        desc += '\n' + escape(programdata['desc'])
-    desc = re.sub(' +', ' ', desc)
-    contentTypeDict = {
-        '교양': 'Arts / Culture (without music)',
-        '만화': 'Cartoons / Puppets',
-        '교육': 'Education / Science / Factual topics',
-        '취미': 'Leisure hobbies',
-        '드라마': 'Movie / Drama',
-        '영화': 'Movie / Drama',
-        '음악': 'Music / Ballet / Dance',
-        '뉴스': 'News / Current affairs',
-        '다큐': 'Documentary',
-        '라이프': 'Documentary',
-        '시사/다큐': 'Documentary',
-        '연예': 'Show / Game show',
-        '스포츠': 'Sports',
-        '홈쇼핑': 'Advertisement / Shopping'
-    }
-    contentType = ''
-    for key, value in contentTypeDict.items():
-        if key in category:
-            contentType = value
-    print('  <programme start="%s +0900" stop="%s +0900" channel="%s">' % (startTime, endTime, ChannelId))
-    print('    <title lang="kr">%s</title>' % programName)
-    if subprogramName:
-        print('    <sub-title lang="kr">%s</sub-title>' % subprogramName)
-    if addverbose == 'y':
-        print('    <desc lang="kr">%s</desc>' % desc)
-        if actors or producers:
-            print('    <credits>')
-            if actors:
-                for actor in actors.split(','):
-                    if actor.strip():
-                        print('      <actor>%s</actor>' % actor.strip())
-            if producers:
-                for producer in producers.split(','):
-                    if producer.strip():
-                        print('      <producer>%s</producer>' % producer.strip())
-            print('    </credits>')
+            desc.append('장르 : ' + squeeze(category))
+        if programdata['actors']:
+            desc.append('출연 : ' + programdata['actors'])
+        if programdata['producers']:
+            desc.append('제작 : ' + programdata['producers'])
+        desc.append('등급 : ' + rating)
+        if programdata['desc']:
+            desc.append(programdata['desc'])
+        lines.append('    <desc lang="kr">%s</desc>' % '\n'.join(desc))
+        if programdata['actorList'] or programdata['producerList']:
+            lines.append('    <credits>')
+            for actor in programdata['actorList']:
+                lines.append('      <actor>%s</actor>' % actor)
+            for producer in programdata['producerList']:
+                lines.append('      <producer>%s</producer>' % producer)
+            lines.append('    </credits>')
     if category:
-        print('    <category lang="kr">%s</category>' % category)
-    if contentType:
-        print('    <category lang="en">%s</category>' % contentType)
-    if episode and addxmltvns == 'y':
-        print('    <episode-num system="xmltv_ns">%s</episode-num>' % episode_ns)
-    if episode and addxmltvns != 'y':
-        print('    <episode-num system="onscreen">%s</episode-num>' % episode_on)
+        lines.append('    <category lang="kr">%s</category>' % category)
+    if programdata['contentType']:
+        lines.append('    <category lang="en">%s</category>' % programdata['contentType'])
+    if episode and profile['addxmltvns'] == 'y':
+        lines.append('    <episode-num system="xmltv_ns">%s</episode-num>' % programdata['episode_ns'])
+    if episode and profile['addxmltvns'] != 'y':
+        lines.append('    <episode-num system="onscreen">%s</episode-num>' % episode)
     if rebroadcast:
-        print('    <previously-shown />')
+        lines.append('    <previously-shown />')
     if rating:
-        print('    <rating system="KMRB">')
-        print('      <value>%s</value>' % rating)
-        print('    </rating>')
-    if ('iconurl' in programdata) and programdata['iconurl']:
-        print('    <icon src="%s" />' % escape(programdata['iconurl']))
-    print('  </programme>')
+        lines.append('    <rating system="KMRB">')
+        lines.append('      <value>%s</value>' % rating)
+        lines.append('    </rating>')
+    if programdata['iconurl']:
+        lines.append('    <icon src="%s" />' % programdata['iconurl'])
+    lines.append('  </programme>\n')
+    profile['output'].write('\n'.join(lines))
 
 
 def writeSKPrograms(ChannelInfo, programs):
@@ -1007,7 +1654,7 @@ def writeSKPrograms(ChannelInfo, programs):
         else:
             category = ''
         rating = int(program['CD_RATING']) if program['CD_RATING'] else 0
-        writeProgram({
+        addProgram({
             'channelId': ChannelInfo[0],
             'startTime': startTime,
             'endTime': endTime,
@@ -1023,10 +1670,34 @@ def writeSKPrograms(ChannelInfo, programs):
         })
 
 
+def epgtime(ymd, hhmm):
+    """미리 만든 날짜(YYYYMMDD)와 'HH:MM' 또는 'HHMM'을 XMLTV 시간(YYYYMMDDHHMMSS)으로
+
+    프로그램마다 strptime/strftime을 거치지 않도록 숫자 검사만 한다.
+    """
+    hh, sep, mm = hhmm.strip().partition(':')
+    if not sep:
+        hh, mm = hh[:-2], hh[-2:]
+    if not (hh.isdigit() and mm.isdigit() and 1 <= len(hh) <= 2 and len(mm) <= 2):
+        raise ValueError('시간 형식이 아닙니다: %s' % hhmm)
+    hour, minute = int(hh), int(mm)
+    if hour > 23 or minute > 59:
+        raise ValueError('시간 형식이 아닙니다: %s' % hhmm)
+    return '%s%02d%02d00' % (ymd, hour, minute)
+
+
+def epgdatetime(ymdhm):
+    """'YYYY-MM-DD HH:MM'을 XMLTV 시간(YYYYMMDDHHMMSS)으로"""
+    ymd = ymdhm[:10].replace('-', '')
+    if len(ymd) != 8 or not ymd.isdigit() or ymdhm[10:11] != ' ':
+        raise ValueError('시간 형식이 아닙니다: %s' % ymdhm)
+    return epgtime(ymd, ymdhm[11:])
+
+
 def load_json(file_path):
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        with open(file_path, 'rb') as f:
+            return json_loads(f.read())
     except Exception as e:
         log.error("파일 읽는 중 에러: %s", file_path)
         log.error(str(e))
@@ -1036,7 +1707,7 @@ def load_json(file_path):
 def dump_json(file_path, data):
     try:
         with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
+            f.write(json_dumps(data, indent=True))
     except Exception as e:
         log.warning("파일 저장 중 에러: %s", file_path)
         log.warning(str(e))
@@ -1048,33 +1719,925 @@ def dump_channels(name_suffix, channels):
     dump_json(filename, headers + channels)
 
 
-def request_data(url, params, method='GET', output='html', session=None, ret=''):
-    sess = requests.Session() if session is None else session
+class XMLFile(object):
+    """XMLTV 파일 출력
+
+    같은 디렉토리의 임시 파일에 쓰고 commit()에서 원래 이름으로 바꾼다.
+    확장자가 .gz이면 gzip, .xz이면 xz로 압축하면서 쓴다.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = os.path.abspath(file_path)
+        dirname, basename = os.path.split(self.file_path)
+        fd, self.tmp_path = tempfile.mkstemp(prefix='.%s.' % basename, suffix='.tmp', dir=dirname)
+        self.raw = os.fdopen(fd, 'wb')
+        ext = os.path.splitext(basename)[1].lower()
+        if ext == '.gz':
+            stream = gzip.GzipFile(filename=basename[:-3], mode='wb', fileobj=self.raw)
+        elif ext == '.xz':
+            if lzma is None:
+                self.abort()
+                raise ValueError('lzma 모듈이 없어 xz로 압축할 수 없습니다: %s' % file_path)
+            stream = lzma.LZMAFile(self.raw, mode='wb')
+        else:
+            stream = self.raw
+        self.stream = io.TextIOWrapper(stream, encoding='utf-8')
+
+    def write(self, s):
+        return self.stream.write(s)
+
+    def flush(self):
+        if not self.stream.closed:
+            self.stream.flush()
+
+    def _close(self):
+        if not self.stream.closed:
+            self.stream.close()     # 압축 스트림의 끝을 기록
+        if not self.raw.closed:
+            self.raw.close()
+
+    def commit(self):
+        self.stream.flush()
+        if self.stream.buffer is not self.raw:
+            self.stream.buffer.close()
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        self._close()
+        # mkstemp는 0600으로 만들기 때문에 umask에 맞춰 다른 사용자(tvheadend)도 읽을 수 있게 한다
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(self.tmp_path, 0o666 & ~umask)
+        os.replace(self.tmp_path, self.file_path)
+
+    def abort(self):
+        try:
+            if hasattr(self, 'stream'):
+                self._close()
+            else:
+                self.raw.close()
+        finally:
+            if os.path.exists(self.tmp_path):
+                os.remove(self.tmp_path)
+
+
+class XMLSocket(object):
+    """XMLTV 소켓 출력
+
+    보내기는 별도 스레드에서 하므로 느리거나 죽은 소비자가 다른 출력을 막지 않는다.
+    쌓인 데이터가 maxchunks를 넘거나 전송에 실패하면 이 소켓만 포기한다.
+    """
+
+    def __init__(self, sock_path, bufsize=64 * 1024, maxchunks=1024, timeout=30):
+        self.sock_path = sock_path
+        self.bufsize = bufsize
+        self.timeout = timeout
+        self.buf = []
+        self.buflen = 0
+        self.error = None
+        self.finished = False
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(sock_path)
+        except OSError:
+            self.sock.close()
+            raise
+        self.queue = queue.Queue(maxchunks)
+        self.thread = threading.Thread(target=self._send, name='xmltv.sock')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _fail(self, reason):
+        if self.error is None:
+            self.error = reason
+            log.error('소켓 출력을 중단합니다: %s: %s', self.sock_path, reason)
+
+    def _send(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            if self.error is None:
+                try:
+                    self.sock.sendall(data)
+                except OSError as e:
+                    self._fail(str(e))
+        # 다른 소켓을 닫기를 기다리지 않고 소비자가 바로 끝을 알 수 있게 한다
+        try:
+            self.sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    def write(self, s):
+        if self.error is None:
+            self.buf.append(s)
+            self.buflen += len(s)
+            if self.buflen >= self.bufsize:
+                self.flush()
+        return len(s)
+
+    def flush(self):
+        if self.buf and self.error is None:
+            data = ''.join(self.buf).encode('utf-8')
+            self.buf, self.buflen = [], 0
+            try:
+                self.queue.put_nowait(data)
+            except queue.Full:
+                self._fail('소비자가 너무 느립니다')
+
+    def commit(self):
+        self.flush()
+        self.finish()
+        self.close()
+
+    def abort(self):
+        self._fail('중단됨')
+        self.finish()
+        self.close()
+
+    def finish(self):
+        # 보낼 데이터 뒤에 끝 표시를 기다리지 않고 넣는다. 큐가 차 있으면 close()에서 넣는다
+        if not self.finished:
+            try:
+                self.queue.put_nowait(None)
+                self.finished = True
+            except queue.Full:
+                pass
+
+    def close(self, deadline=None):
+        """deadline(time.time() 기준)까지 남은 데이터를 보내고 닫는다. 없으면 지금부터 timeout초"""
+        if deadline is None:
+            deadline = time.time() + self.timeout
+        if not self.finished:
+            try:
+                self.queue.put(None, timeout=max(0, deadline - time.time()))
+                self.finished = True
+            except queue.Full:
+                self._fail('소비자가 너무 느립니다')
+        self.thread.join(max(0, deadline - time.time()))
+        if self.thread.is_alive():
+            self._fail('전송 시간 초과')
+            self.sock.shutdown(socket.SHUT_RDWR)     # 막혀있는 sendall을 깨운다
+            if not self.finished:
+                self.queue.put(None)    # 에러가 난 뒤로는 보내지 않고 비우기만 하므로 곧 들어간다
+                self.finished = True
+            self.thread.join()
+        self.sock.close()
+
+
+class XMLOutput(object):
+    """한 번 만든 XMLTV를 여러 출력(화면, 파일, 소켓)에 동시에 쓴다."""
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+        self.done = False
+        self.closer = None
+
+    def write(self, s):
+        for sink in self.sinks:
+            sink.write(s)
+        return len(s)
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+
+    def commit(self, wait=True):
+        """소켓마다 끝 표시를 먼저 넣고 파일을 마무리한 뒤, 모든 소켓을 같은 마감 시간까지 기다린다
+
+        느린 소비자 하나가 다음 소켓의 끝을 늦추지 않는다. wait=False이면 소켓은 다른 스레드에서 기다리고
+        바로 돌아온다 (join()으로 기다린다).
+        """
+        self.done = True
+        sockets = [sink for sink in self.sinks if isinstance(sink, XMLSocket)]
+        for sink in self.sinks:
+            try:
+                if sink in sockets:
+                    sink.flush()
+                    sink.finish()
+                else:
+                    sink.commit() if hasattr(sink, 'commit') else sink.flush()
+            except Exception as e:
+                log.error('출력 마무리 중 에러: %s', str(e))
+        deadline = time.time() + max([sink.timeout for sink in sockets] or [0])
+        if wait or not sockets:
+            self._close(sockets, deadline)
+        else:
+            self.closer = threading.Thread(target=self._close, args=(sockets, deadline), name='xmltv.close')
+            self.closer.daemon = True
+            self.closer.start()
+
+    def _close(self, sockets, deadline):
+        for sink in sockets:
+            try:
+                sink.close(deadline)
+            except Exception as e:
+                log.error('출력 마무리 중 에러: %s', str(e))
+
+    def join(self):
+        if self.closer is not None:
+            self.closer.join()
+
+    def abort(self):
+        if self.done:
+            return
+        self.done = True
+        for sink in self.sinks:
+            try:
+                sink.abort() if hasattr(sink, 'abort') else sink.flush()
+            except Exception as e:
+                log.error('출력 정리 중 에러: %s', str(e))
+
+
+class Journal(object):
+    """작업 기록(journal)
+
+    끝난 작업 단위(소스, 서비스 아이디, 날짜)와 그 결과를 한 줄씩 기록한다.
+    중간에 죽은 실행을 --resume으로 다시 시작하면 기록된 단위는 요청하지 않는다.
+    """
+
+    def __init__(self, file_path, resume=False, readonly=False):
+        self.file_path = file_path
+        self.units = {}
+        self.f = None
+        line = '\n'
+        if resume and os.path.exists(file_path):
+            with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+                for line in f:
+                    try:
+                        entry = json_loads(line)
+                    except ValueError:
+                        continue    # 죽을 때 쓰다 만 줄
+                    self.units[tuple(entry['unit'])] = entry['rows']
+            log.info('작업 기록에서 %s개 단위를 이어서 사용합니다: %s', len(self.units), file_path)
+        if readonly:
+            return
+        self.f = open(file_path, 'a' if resume else 'w', encoding='utf-8')
+        if not line.endswith('\n'):
+            self.f.write('\n')
+
+    def get(self, source, ServiceId, ymd):
+        return self.units.get((source, str(ServiceId), ymd))
+
+    def put(self, source, ServiceId, ymd, rows):
+        unit = (source, str(ServiceId), ymd)
+        if unit in self.units or self.f is None:
+            return
+        self.f.write(json_dumps({'unit': unit, 'rows': rows}) + '\n')
+        self.f.flush()
+
+    def close(self, remove=False):
+        if self.f is None:
+            return
+        self.f.close()
+        if remove and os.path.exists(self.file_path):
+            os.remove(self.file_path)
+
+
+class EPGStore(object):
+    """EPG 저장소 (SQLite)
+
+    정리된 프로그램을 (채널, 시작 시간)을 키로 저장하고 출력은 여기서 채널별로 시간 순서대로 읽어서 한다.
+    채널마다 마지막으로 가져온 범위(first)를 기억하므로 다시 출력하거나 일부 채널만 출력할 때,
+    지난 EPG와 비교할 때 네트워크 요청 없이 쿼리로 할 수 있다.
+    """
+
+    def __init__(self, file_path):
+        self.db = sqlite3.connect(file_path)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS channels (
+                id TEXT PRIMARY KEY,
+                seq INTEGER,
+                source TEXT,
+                first TEXT,
+                updated TEXT,
+                data TEXT
+            );
+            CREATE TABLE IF NOT EXISTS programmes (
+                channel TEXT,
+                start TEXT,
+                stop TEXT,
+                source TEXT,
+                title TEXT,
+                category TEXT,
+                data TEXT,
+                PRIMARY KEY (channel, start)
+            );
+            CREATE INDEX IF NOT EXISTS programmes_time ON programmes (start, stop);
+            CREATE INDEX IF NOT EXISTS programmes_source ON programmes (source, start);
+            CREATE TABLE IF NOT EXISTS units (
+                source TEXT,
+                sid TEXT,
+                ymd TEXT,
+                fetched TEXT,
+                rows TEXT,
+                PRIMARY KEY (source, sid, ymd)
+            );
+            CREATE TABLE IF NOT EXISTS stats (
+                key TEXT PRIMARY KEY,
+                count INTEGER,
+                seconds REAL,
+                updated TEXT
+            );
+        ''')
+        self.seq = 0
+        self.reused = 0
+        self.updated = datetime.now().strftime('%Y/%m/%d %H:%M:%S')
+
+    def put_channel(self, channel):
+        self.seq += 1
+        self.db.execute('INSERT OR REPLACE INTO channels (id, seq, source, first, updated, data) VALUES (?, ?, ?, NULL, ?, ?)',
+                        (str(channel['Id']), self.seq, channel['Source'], self.updated, json_dumps(channel)))
+
+    def put_programs(self, ChannelId, source, programs):
+        """시간 순으로 정리된 한 채널의 프로그램으로 그 시작 이후의 기존 프로그램을 바꾼다"""
+        if not programs:
+            return
+        ChannelId = str(ChannelId)
+        first = programs[0]['startTime']
+        self.db.execute('DELETE FROM programmes WHERE channel = ? AND start >= ?', (ChannelId, first))
+        self.db.executemany('INSERT OR REPLACE INTO programmes (channel, start, stop, source, title, category, data) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            ((ChannelId, x['startTime'], x['endTime'], source, x['programName'], x['category'], json_dumps(x)) for x in programs))
+        self.db.execute('UPDATE channels SET first = ? WHERE id = ?', (first, ChannelId))
+
+    def get_unit(self, source, ServiceId, ymd):
+        """refresh_days 안에 가져온 요청 단위(소스, 서비스 아이디, 날짜)의 결과"""
+        fresh = (today - timedelta(days=refresh_days - 1)).strftime('%Y%m%d')
+        row = self.db.execute('SELECT rows FROM units WHERE source = ? AND sid = ? AND ymd = ? AND fetched >= ?',
+                              (source, str(ServiceId), ymd, fresh)).fetchone()
+        if row is None:
+            return None
+        self.reused += 1
+        return json_loads(row[0])
+
+    def put_unit(self, source, ServiceId, ymd, rows):
+        self.db.execute('INSERT OR REPLACE INTO units (source, sid, ymd, fetched, rows) VALUES (?, ?, ?, ?, ?)',
+                        (source, str(ServiceId), ymd, today.strftime('%Y%m%d'), json_dumps(rows)))
+
+    def put_stats(self, stats):
+        """이번 실행의 요청 기록(키 -> [수, 초])으로 바꾼다"""
+        self.db.executemany('INSERT OR REPLACE INTO stats (key, count, seconds, updated) VALUES (?, ?, ?, ?)',
+                            ((key, x[0], x[1], self.updated) for key, x in stats.items()))
+
+    def get_stat(self, key):
+        """마지막으로 기록한 (요청 수, 초), 없으면 None"""
+        return self.db.execute('SELECT count, seconds FROM stats WHERE key = ?', (key,)).fetchone()
+
+    def commit(self):
+        # 오래된 프로그램과 지난 날짜나 오래된 요청 단위 정리
+        oldest = (today - timedelta(days=store_days)).strftime('%Y%m%d') + '000000'
+        self.db.execute('DELETE FROM programmes WHERE stop < ?', (oldest,))
+        fresh = (today - timedelta(days=max(refresh_days, 1) - 1)).strftime('%Y%m%d')
+        self.db.execute("DELETE FROM units WHERE fetched < ? OR (ymd != '' AND ymd < ?)", (fresh, today.strftime('%Y%m%d')))
+        self.db.commit()
+
+    def channels(self):
+        """마지막으로 실행할 때 가져온 채널 정보를 그 순서대로"""
+        cursor = self.db.execute('SELECT data FROM channels WHERE updated = (SELECT MAX(updated) FROM channels) ORDER BY seq')
+        return [json_loads(row[0]) for row in cursor]
+
+    def programs(self, ChannelId):
+        """채널의 마지막으로 가져온 프로그램을 시간 순으로 하나씩"""
+        for row in self.timeline(ChannelId):
+            yield json_loads(row[2])
+
+    def timeline(self, ChannelId):
+        """채널의 마지막으로 가져온 프로그램을 시간 순으로 (시작, 종료, JSON) 커서로"""
+        return self.db.execute('''
+            SELECT p.start, p.stop, p.data FROM programmes p JOIN channels c ON c.id = p.channel
+            WHERE p.channel = ? AND p.start >= c.first ORDER BY p.start''', (str(ChannelId),))
+
+    def close(self):
+        self.db.close()
+
+
+class EPGIndex(object):
+    """EPG 서버용 메모리 색인
+
+    채널별로 시작/종료 시간 목록과 프로그램 JSON을 시간 순서대로 들고 있다가
+    시간 범위에 걸치는 프로그램만 이진 탐색으로 찾아서 디코딩한다.
+    """
+
+    def __init__(self, store):
+        self.version = datetime.now().strftime('%Y%m%d%H%M%S')
+        self.channels = OrderedDict()
+        self.starts, self.stops, self.rows = {}, {}, {}
+        for channel in EPGChannels.values():
+            ChannelId = str(channel['Id'])
+            rows = store.timeline(ChannelId).fetchall()
+            self.channels[ChannelId] = channel
+            self.starts[ChannelId] = [x[0] for x in rows]
+            self.stops[ChannelId] = [x[1] for x in rows]
+            self.rows[ChannelId] = [x[2] for x in rows]
+
+    def query(self, ChannelIds, start, stop):
+        """[start, stop)에 걸치는 프로그램을 채널별로: (채널 정보, 프로그램 목록)"""
+        for ChannelId in ChannelIds or self.channels:
+            if ChannelId not in self.channels:
+                continue
+            lo = bisect_right(self.stops[ChannelId], start) if start else 0
+            hi = bisect_left(self.starts[ChannelId], stop) if stop else len(self.starts[ChannelId])
+            yield self.channels[ChannelId], [json_loads(x) for x in self.rows[ChannelId][lo:hi]]
+
+
+def querytime(value):
+    """'YYYYMMDD[HH[MM[SS]]]'를 XMLTV 시간(YYYYMMDDHHMMSS)으로"""
+    if not value:
+        return ''
+    if not (value.isdigit() and len(value) in (8, 10, 12, 14)):
+        raise ValueError('시간 형식이 아닙니다: %s' % value)
+    return value.ljust(14, '0')
+
+
+def jsonChannel(channel, programs):
+    # 저장된 프로그램 정보는 XML용으로 이스케이프되어 있으므로 되돌린다
+    return {
+        'id': channel['Id'],
+        'name': channel['Name'],
+        'icon': channel.get('Icon_url', ''),
+        'programmes': [{
+            'start': x['startTime'],
+            'stop': x['endTime'],
+            'title': unescape(x['programName']),
+            'sub-title': unescape(x['subprogramName']),
+            'desc': unescape(x['desc']),
+            'category': unescape(x['category']),
+            'episode': x['episode'],
+            'rebroadcast': x['rebroadcast'],
+            'rating': x['rating'],
+            'actors': [unescape(a) for a in x['actorList']],
+            'producers': [unescape(a) for a in x['producerList']],
+            'icon': unescape(x['iconurl']),
+        } for x in programs],
+    }
+
+
+class EPGRequestHandler(BaseHTTPRequestHandler):
+    """GET /xmltv 또는 /json ?channel=1,2&from=YYYYMMDDHHMM&to=YYYYMMDDHHMM"""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        log.debug('%s %s', self.address_string(), format % args)
+
+    def do_GET(self):
+        u = urlparse(self.path)
+        if u.path not in ('/xmltv', '/json'):
+            return self.reply(404, 'text/plain', b'not found')
+        q = parse_qs(u.query)
+        ChannelIds = [x.strip() for v in q.get('channel', []) for x in v.split(',') if x.strip()]
+        try:
+            start = querytime(q.get('from', [''])[0])
+            stop = querytime(q.get('to', [''])[0])
+        except ValueError as e:
+            return self.reply(400, 'text/plain', str(e).encode('utf-8'))
+
+        gz = 'gzip' in self.headers.get('Accept-Encoding', '')
+        key = '%s|%s|%s|%s' % (u.path, ','.join(ChannelIds), start, stop)
+        etag = '"%s-%s%s"' % (self.server.index.version, hashlib.md5(key.encode('utf-8')).hexdigest()[:16], '-gz' if gz else '')
+        if etag in self.headers.get('If-None-Match', ''):
+            return self.reply(304, None, b'', etag)
+
+        results = self.server.index.query(ChannelIds, start, stop)
+        if u.path == '/json':
+            ctype = 'application/json'
+            body = json_dumps([jsonChannel(channel, programs) for channel, programs in results])
+        else:
+            ctype = 'application/xml'
+            out = io.StringIO()
+            profile = dict(self.server.profile, output=out)
+            results = list(results)
+            writeXMLHeader(out)
+            for channel, _ in results:
+                writeChannel(channel, profile)
+            for _, programs in results:
+                for programdata in programs:
+                    writeProgram(programdata, profile)
+            print('</tv>', file=out)
+            body = out.getvalue()
+        body = body.encode('utf-8')
+        if gz:
+            body = gzip.compress(body)
+        self.reply(200, ctype, body, etag, gz)
+
+    def reply(self, code, ctype, body, etag=None, gz=False):
+        self.send_response(code)
+        if ctype:
+            self.send_header('Content-Type', ctype + '; charset=utf-8')
+        if etag:
+            self.send_header('ETag', etag)
+            self.send_header('Vary', 'Accept-Encoding')
+        if gz:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class EPGServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serveEpg(index):
+    try:
+        server = EPGServer(serve_address, EPGRequestHandler)
+    except OSError as e:
+        log.error('EPG 서버를 시작할 수 없습니다: %s:%s: %s', serve_address[0], serve_address[1], str(e))
+        sys.exit(1)
+    server.index = index
+    server.profile = profiles[0]
+    log.info('EPG 서버 시작: http://%s:%s/xmltv, /json (%s개 채널)', serve_address[0], server.server_address[1], len(index.channels))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    log.info('EPG 서버 종료')
+
+
+class BudgetExceeded(Exception):
+    """default_request_budget만큼 요청해서 더 요청하지 않음"""
+
+
+def budgetExceeded():
+    # 예산을 다 썼으면 처음 한 번만 알린다
+    global budget_warned
+    if request_budget <= 0 or request_count < request_budget:
+        return False
+    if not budget_warned:
+        budget_warned = True
+        log.warning('요청 예산 %s건을 다 썼습니다. 남은 채널과 날짜는 가져오지 않습니다.', request_budget)
+    return True
+
+
+def cached(source, ServiceId, ymd):
+    """작업 기록에 있거나 다시 가져오지 않아도 되는 지난 결과, 없으면 None
+
+    default_refresh_days가 0보다 크면 오늘과 내일을 뺀 날짜(와 날짜가 없는 단위)는
+    그 일수 안에 가져온 결과가 저장소에 있으면 다시 요청하지 않는다.
+    """
+    rows = journal.get(source, ServiceId, ymd)
+    if rows is None and refresh_days > 0 and (not ymd or ymd >= refresh_from):
+        rows = store.get_unit(source, ServiceId, ymd)
+    return rows
+
+
+def remember(source, ServiceId, ymd, rows):
+    journal.put(source, ServiceId, ymd, rows)
+    if refresh_days > 0:
+        store.put_unit(source, ServiceId, ymd, rows)
+
+
+def servicesKey(ServiceIds):
+    """서비스 아이디 목록을 작업 단위 키에 넣을 짧은 해시로 (순서와 상관없이 같은 목록이면 같음)"""
+    return hashlib.md5(','.join(sorted(set(ServiceIds))).encode('utf-8')).hexdigest()[:12]
+
+
+def checkpoint(source, ServiceId, ymd, fetch, budgeted=True):
+    """cached()에 있으면 그 결과를, 없으면 fetch()의 결과를 기록하고 돌려준다 (None은 실패로 보고 기록하지 않음)
+
+    budgeted가 False이면 요청 예산을 다 써도 요청한다.
+    """
+    rows = cached(source, ServiceId, ymd)
+    if rows is None:
+        if budgeted and budgetExceeded():
+            raise BudgetExceeded
+        rows = fetch()
+        if rows is not None:
+            remember(source, ServiceId, ymd, rows)
+    return rows
+
+
+def fetchParallel(tasks, fetch, retries=1, budgeted=True):
+    """tasks의 작업마다 fetch(*task)를 default_workers개까지 동시에 요청하고 끝나는 대로 (task, 결과)를 하나씩
+
+    실패한 작업은 그 작업만 retries번까지 다시 요청하고 그래도 실패하면 결과는 None이다.
+    요청 예산을 다 쓰면 남은 작업은 요청하지 않고 돌려주지도 않는다 (budgeted가 False이면 모두 요청).
+    기록(remember)과 저장소는 스레드 사이에 나누어 쓸 수 없으므로 결과는 부른 쪽에서 처리한다.
+    """
+    pending = deque((task, 0) for task in tasks)
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            while pending and len(running) < workers and not (budgeted and budgetExceeded()):
+                task, tries = pending.popleft()
+                running[executor.submit(fetch, *task)] = (task, tries)
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task, tries = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if tries < retries:
+                        log.warning('다시 요청합니다: %s', str(e))
+                        pending.append((task, tries + 1))
+                        continue
+                    log.error('요청 중 에러: %s', str(e))
+                    result = None
+                yield task, result
+
+
+def as_list(value):
+    """설정값을 리스트로: 리스트는 그대로, 문자열은 하나짜리 리스트"""
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+def upstream_url(url):
+    """--upstream이 지정되면 원래 주소를 UPSTREAM/호스트/경로로 바꾼다"""
+    if not args['upstream']:
+        return url
+    u = urlparse(url)
+    return '%s/%s%s%s' % (args['upstream'].rstrip('/'), u.netloc, u.path, '?' + u.query if u.query else '')
+
+
+def count_request():
+    global request_count
+    with request_lock:
+        request_count += 1
+
+
+def add_stat(key, count=1, seconds=0.0):
+    # 호스트별 요청 수와 걸린 시간 등 --plan이 다음 실행에서 참고할 기록
+    with request_lock:
+        stat = request_stats.setdefault(key, [0, 0.0])
+        stat[0] += count
+        stat[1] += seconds
+
+
+def percentile(values, q):
+    # 정렬된 values의 q(0-1) 분위수
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def endpointOf(url):
+    """응답 시간을 모으는 단위: 호스트와 경로 (숫자가 든 마지막 경로는 프로그램 아이디 등이라서 뺀다)
+
+    같은 호스트라도 경로마다 응답 크기가 크게 다르다 (예: WAVVE의 상세 정보와 전체 편성표).
+    """
+    u = urlparse(url)
+    return u.netloc + re.sub(r'/[^/]*\d[^/]*$', '', u.path)
+
+
+def latencyOf(endpoint, q):
+    """이번 실행에서 endpoint의 응답 시간 q 분위수, 아직 latency_samples개가 안 되면 None"""
+    with request_lock:
+        values = request_latencies.get(endpoint)
+        if not values or len(values) < latency_samples:
+            return None
+        return percentile(values, q)
+
+
+def timeoutOf(endpoint):
+    # endpoint의 p99의 세 배 (2초에서 req_timeout 사이), 기록이 모자라면 req_timeout
+    p99 = latencyOf(endpoint, 0.99)
+    return req_timeout if p99 is None else min(req_timeout, max(2.0, p99 * 3))
+
+
+def send_request(sess, method, url, params, host, endpoint, counted=True, stream=False):
+    """한 번 요청하고 걸린 시간을 기록한다. 헤지로 한 번 더 보내는 요청은 counted=False로 예산에 세지 않는다
+
+    stream=True이면 본문은 읽지 않고 응답 헤더까지 걸린 시간을 기록한다.
+    """
+    if counted:
+        count_request()
+    started = time.time()
     try:
         if method == 'GET':
-            r = sess.get(url, params=params, timeout=req_timeout)
+            r = sess.get(url, params=params, timeout=timeoutOf(endpoint), stream=stream)
         elif method == 'POST':
-            r = sess.post(url, data=params, timeout=req_timeout)
+            r = sess.post(url, data=params, timeout=timeoutOf(endpoint))
         else:
             raise ValueError('Unexpected method: %s', method)
         r.raise_for_status()
+        return r
+    finally:
+        seconds = time.time() - started
+        add_stat(host, 1, seconds)
+        with request_lock:
+            insort(request_latencies.setdefault(endpoint, []), seconds)
+
+
+def hedged(call, endpoint):
+    """call()이 endpoint의 p95 안에 끝나지 않으면 같은 요청을 한 번 더 보내서 먼저 성공한 응답을 쓴다
+
+    편성표 요청은 모두 조회라서 두 번 보내도 된다. 한 번 더 보내는 요청은 call(counted=False)로 부르고,
+    늦은 쪽은 아직 시작하지 않았으면 취소하고 이미 보냈으면 응답을 버린다.
+    """
+    p95 = latencyOf(endpoint, 0.95) if hedge else None
+    if p95 is None:
+        return call()
+    first = hedge_pool.submit(call)
+    try:
+        return first.result(timeout=p95)
+    except FutureTimeoutError:
+        pass
+    if budgetExceeded():
+        return first.result()
+    with request_lock:
+        hedge_counts[endpoint] = hedge_counts.get(endpoint, 0) + 1
+    futures = [first, hedge_pool.submit(call, counted=False)]
+    while True:
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+            futures.remove(future)
+            if future.exception() is None or not futures:
+                for loser in futures:
+                    if not loser.cancel():
+                        loser.add_done_callback(closeResponse)
+                return future.result()
+
+
+def closeResponse(future):
+    # 헤지에서 늦게 온 응답은 버리고 (stream=True이면 잡고 있는) 연결을 돌려준다
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+def reportLatencies():
+    # 헤지에서 늦은 요청이 아직 기록 중일 수 있으므로 잠그고 복사해서 출력
+    hedge_pool.shutdown(wait=False)
+    with request_lock:
+        latencies = [(endpoint, list(values)) for endpoint, values in sorted(request_latencies.items())]
+        hedges = dict(hedge_counts)
+    for endpoint, values in latencies:
+        log.info('%s 응답 시간 p50 %.3f초, p95 %.3f초, p99 %.3f초 (%s건, 헤지 %s건, 타임아웃 %.1f초)', endpoint,
+                 percentile(values, 0.5), percentile(values, 0.95), percentile(values, 0.99),
+                 len(values), hedges.get(endpoint, 0), timeoutOf(endpoint))
+
+
+def response_json(r):
+    # 선언된 문자셋이 없거나 UTF-8이면 bytes를 그대로 빠른 JSON 모듈에 넘기고, 아니면(EUC-KR 등) r.text로 디코딩해서 넘긴다
+    if r.encoding is None or r.encoding.lower().replace('-', '').replace('_', '') == 'utf8':
+        return json_loads(r.content)
+    return json_loads(r.text)
+
+
+def request_data(url, params, method='GET', output='html', session=None, ret=''):
+    sess = requests.Session() if session is None else session
+    host, endpoint = urlparse(url).netloc, endpointOf(url)
+    url = upstream_url(url)
+    try:
+        r = hedged(partial(send_request, sess, method, url, params, host, endpoint), endpoint)
         if output.lower() == 'html':
             ret = r.text
         elif output.lower() == 'json':
-            ret = r.json()
+            ret = response_json(r)
         else:
             raise ValueError('Unexpected output type: %s', output)
     except Exception as e:
-        log.error('요청 중 에러: %s' % str(e))
+        log.error('요청 중 에러: %s', str(e))
     time.sleep(req_sleep)
     return ret
 
 
+def request_items(url, params, prefix, session=None, values=None):
+    """GET 요청의 JSON 응답에서 prefix(예: 'list.item') 아래 항목을 하나씩 돌려준다
+
+    ijson이 있으면 응답을 통째로 메모리에 올리지 않고 받는 대로 디코딩한다.
+    values(dict)를 주면 같은 응답의 최상위 값(예: pagecount)을 다 읽은 뒤에 담는다.
+    요청은 request_data()처럼 endpoint별 타임아웃과 헤지를 쓰고, 에러는 호출한 쪽에서 처리한다.
+    """
+    sess = requests.Session() if session is None else session
+    host, endpoint = urlparse(url).netloc, endpointOf(url)
+    url = upstream_url(url)
+    try:
+        r = hedged(partial(send_request, sess, 'GET', url, params, host, endpoint, stream=ijson is not None), endpoint)
+        if ijson is None:
+            data = response_json(r)
+            if values is not None:
+                values.update((k, v) for k, v in data.items() if not isinstance(v, (dict, list)))
+            for key in prefix.split('.')[:-1]:
+                data = data[key]
+            for item in data:
+                yield item
+        else:
+            try:
+                r.raw.decode_content = True
+                events = ijson.parse(r.raw, use_float=True)
+                for current, event, value in events:
+                    if current == prefix and event in ('start_map', 'start_array'):
+                        # ijson.items()처럼 prefix 아래 항목 하나를 만들어서 돌려준다
+                        builder, end = ijson.ObjectBuilder(), event.replace('start', 'end')
+                        while (current, event) != (prefix, end):
+                            builder.event(event, value)
+                            current, event, value = next(events)
+                        yield builder.value
+                    elif current == prefix:
+                        yield value
+                    elif values is not None and current and '.' not in current and event not in ('map_key', 'start_map', 'start_array', 'end_map', 'end_array'):
+                        values[current] = value
+            finally:
+                r.close()
+    finally:
+        time.sleep(req_sleep)
+
+
+def parse_channels(value):
+    """MyChannels 형식('1,3-5,7-', '*')의 채널 ID를 문자열 목록으로"""
+    cids = [x['Id'] for x in Channeldatajson if 'Id' in x]
+    min_cid, max_cid = min(cids), max(cids)
+    cid_bin = [0] * (max_cid+1)
+    for r in value.strip('"').strip("'").split(','):
+        first, last = min_cid-1, max_cid
+        if r.strip() != '*':
+            ends = r.split('-')
+            if len(ends) == 1:
+                first = last = int(r)
+            elif len(ends) == 2:
+                a, b = ends
+                first = int(a) if a.strip() != '' else first
+                last = int(b) if b.strip() != '' else last
+            else:
+                log.error('MyChannels 범위에 문제가 있습니다: %s', value)
+                sys.exit(1)
+        if first < min_cid:
+            first = min_cid
+        if last >= max_cid:
+            last = max_cid
+        for i in range(first, last+1):
+            cid_bin[i] = 1
+    return [str(x) for x, y in enumerate(cid_bin) if y == 1]
+
+
+def load_profile(pconf):
+    """설정을 검사해서 출력 프로파일을 만든다"""
+    MyISP = pconf['MyISP']
+    if not any(MyISP in s for s in ['ALL', 'KT', 'LG', 'SK']):
+        log.error("MyISP는 ALL, KT, LG, SK만 가능합니다.")
+        sys.exit(1)
+
+    MyChannels = parse_channels(pconf['MyChannels'])
+
+    outputs = pconf['output'] if isinstance(pconf['output'], list) else pconf['output'].split(',')
+    outputs = [x.strip() for x in outputs if x.strip()]
+    if not outputs or not all(x in ['d', 'o', 's'] for x in outputs):
+        log.error("output은 d, o, s만 가능합니다.")
+        sys.exit(1)
+
+    for k in ['default_rebroadcast', 'default_episode', 'default_verbose', 'default_xmltvns']:
+        if not any(pconf[k] in s for s in 'yn'):
+            log.error("%s는 y, n만 가능합니다.", k)
+            sys.exit(1)
+
+    return {
+        'name': pconf['name'],
+        'MyISP': MyISP,
+        'MyChannels': MyChannels,
+        'outputs': outputs,
+        'xml_files': as_list(pconf['default_xml_file']),
+        'xml_sockets': as_list(pconf['default_xml_socket']),
+        'IconUrl': pconf['default_icon_url'],
+        'addrebroadcast': pconf['default_rebroadcast'],
+        'addepisode': pconf['default_episode'],
+        'addverbose': pconf['default_verbose'],
+        'addxmltvns': pconf['default_xmltvns'],
+    }
+
+
+def open_output(profile, preview=False):
+    """프로파일의 출력(화면, 파일, 소켓)을 연다. 실패하면 None
+
+    preview는 --progressive에서 먼저 내보내는 출력으로 두 번 출력하면 안 되는 화면은 빼고,
+    출력할 곳이 없어도 에러로 보지 않는다.
+    """
+    sinks = []
+    if 'd' in profile['outputs'] and not preview:
+        sinks.append(sys.stdout)
+    if 'o' in profile['outputs']:
+        for xml_file in profile['xml_files']:
+            try:
+                sinks.append(XMLFile(xml_file))
+            except (OSError, ValueError) as e:
+                log.error('XML 파일을 만들 수 없습니다: %s', str(e))
+                XMLOutput(sinks).abort()
+                return None
+    if 's' in profile['outputs']:
+        for xml_socket in profile['xml_sockets']:
+            try:
+                sinks.append(XMLSocket(xml_socket))
+            except OSError:
+                log.error('소켓 파일을 찾을 수 없습니다: %s', xml_socket)
+    if not sinks:
+        if not preview:
+            log.error('%s 프로파일에 출력할 곳이 없습니다.', profile['name'])
+        return None
+    return XMLOutput(sinks)
+
+
 Channeldatajson = load_json(args['channelfile'])
 json_conf = load_json(args['configfile'])
 
 log.debug('설정을 읽어오는 중 ...')
 
+# 프로파일(profiles)마다 따로 지정할 수 있는 설정
+profile_keys = [
+    'MyISP', 'MyChannels', 'output', 'default_xml_file', 'default_xml_socket', 'default_icon_url',
+    'default_rebroadcast', 'default_episode', 'default_verbose', 'default_xmltvns',
+]
+
 # default config
 conf = {
     'MyISP': 'ALL',
@@ -1088,6 +2651,14 @@ conf = {
     'default_episode': 'y',
     'default_verbose': 'n',
     'default_xmltvns': 'n',
+    'default_dead_days': '7',
+    'default_refresh_days': '0',
+    'default_priority': '5',
+    'default_request_budget': '0',
+    'default_workers': '4',
+    'default_sk_chunk_size': '20',
+    'default_wavve_daily': 'n',
+    'default_hedge': 'y',
 }
 for k in conf:
     if k in args and args[k]:
@@ -1102,80 +2673,163 @@ for k in conf:
 #
 # validate settings
 #
-MyISP = conf['MyISP']
-if not any(MyISP in s for s in ['ALL', 'KT', 'LG', 'SK']):
-    log.error("MyISP는 ALL, KT, LG, SK만 가능합니다.")
+profiles = []
+for pconf in json_conf.get('profiles') or [{}]:
+    _conf = dict(conf)
+    for k in profile_keys:
+        if k in pconf and pconf[k]:
+            _conf[k] = pconf[k]
+    _conf['name'] = pconf.get('name', 'default')
+    profiles.append(load_profile(_conf))
+
+# 모든 프로파일의 채널을 합쳐서 한 번에 가져온다
+MyChannels = set()
+for profile in profiles:
+    MyChannels.update(profile['MyChannels'])
+
+if not any(conf['default_fetch_limit'] in s for s in '1234567'):
+    log.error("default_fetch_limit은 1-7만 가능합니다.")
     sys.exit(1)
+else:
+    period = int(conf['default_fetch_limit'])
 
-cids = [x['Id'] for x in Channeldatajson if 'Id' in x]
-min_cid, max_cid = min(cids), max(cids)
-cid_bin = [0] * (max_cid+1)
-for r in conf['MyChannels'].strip('"').strip("'").split(','):
-    first, last = min_cid-1, max_cid
-    if r.strip() != '*':
-        ends = r.split('-')
-        if len(ends) == 1:
-            first = last = int(r)
-        elif len(ends) == 2:
-            a, b = ends
-            first = int(a) if a.strip() != '' else first
-            last = int(b) if b.strip() != '' else last
-        else:
-            log.error('MyChannels 범위에 문제가 있습니다: %s', conf['MyChannels'])
-            sys.exit(1)
-    if first < min_cid:
-        first = min_cid
-    if last >= max_cid:
-        last = max_cid
-    for i in range(first, last+1):
-        cid_bin[i] = 1
-MyChannels = [str(x) for x, y in enumerate(cid_bin) if y == 1]
-
-if not any(conf['output'] in s for s in ['d', 'o', 's']):
-    log.error("output은 d, o, s만 가능합니다.")
+# 채널별 우선순위와 가져오는 일수: Channel.json의 Priority/FetchLimit > channel_tiers > 기본값
+for k in ['default_priority', 'default_request_budget']:
+    if not str(conf[k]).isdigit():
+        log.error("%s는 0 이상의 숫자만 가능합니다.", k)
+        sys.exit(1)
+for k in ['default_workers', 'default_sk_chunk_size']:
+    if not str(conf[k]).isdigit() or int(conf[k]) < 1:
+        log.error("%s는 1 이상의 숫자만 가능합니다.", k)
+        sys.exit(1)
+workers = int(conf['default_workers'])
+sk_chunk_size = int(conf['default_sk_chunk_size'])
+if conf['default_wavve_daily'] not in ['y', 'n']:
+    log.error("default_wavve_daily는 y, n만 가능합니다.")
     sys.exit(1)
-if conf['output'] == 'o':
-    sys.stdout = open(conf['default_xml_file'], 'w', encoding='utf-8')
-elif conf['output'] == 's':
-    try:
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        sock.connect(conf['default_xml_socket'])
-        sockfile = sock.makefile('w')
-        sys.stdout = sockfile
-    except socket.error:
-        log.error('xmltv.sock 파일을 찾을 수 없습니다.')
+wavve_daily = conf['default_wavve_daily'] == 'y'
+if conf['default_hedge'] not in ['y', 'n']:
+    log.error("default_hedge는 y, n만 가능합니다.")
+    sys.exit(1)
+hedge = conf['default_hedge'] == 'y'
+hedge_pool = ThreadPoolExecutor(max_workers=workers * 2)
+default_plan = (int(conf['default_priority']), period)
+request_budget = int(conf['default_request_budget'])
+request_count = 0
+request_lock = threading.Lock()
+request_stats = {}
+request_latencies = {}     # 호스트와 경로(endpointOf) -> 정렬된 응답 시간 목록
+hedge_counts = {}
+budget_warned = False
+
+ChannelPlans = {}
+for tier in reversed(json_conf.get('channel_tiers') or []):
+    priority = str(tier.get('priority', conf['default_priority']))
+    fetch_limit = str(tier.get('fetch_limit', period))
+    if not priority.isdigit() or fetch_limit not in list('1234567') or not tier.get('MyChannels'):
+        log.error('channel_tiers에 문제가 있습니다: %s', tier)
         sys.exit(1)
-
-IconUrl = conf['default_icon_url']
-
-if not any(conf['default_rebroadcast'] in s for s in 'yn'):
-    log.error("default_rebroadcast는 y, n만 가능합니다.")
+    for cid in parse_channels(tier['MyChannels']):
+        ChannelPlans[cid] = (int(priority), int(fetch_limit))
+for c in Channeldatajson:
+    if 'Id' in c and ('Priority' in c or 'FetchLimit' in c):
+        priority, fetch_limit = ChannelPlans.get(str(c['Id']), default_plan)
+        ChannelPlans[str(c['Id'])] = (int(c.get('Priority', priority)), min(max(int(c.get('FetchLimit', fetch_limit)), 1), 7))
+period = max([period] + [x[1] for x in ChannelPlans.values()])
+fetch_days = range(0, period)   # 가져올 날 (0: 오늘), fetchEpg()에서 바뀜
+
+if not str(conf['default_dead_days']).isdigit():
+    log.error("default_dead_days는 0 이상의 숫자만 가능합니다.")
     sys.exit(1)
 else:
-    addrebroadcast = conf['default_rebroadcast']
+    dead_days = int(conf['default_dead_days'])
 
-if not any(conf['default_episode'] in s for s in 'yn'):
-    log.error("default_episode는 y, n만 가능합니다.")
+if not str(conf['default_refresh_days']).isdigit():
+    log.error("default_refresh_days는 0 이상의 숫자만 가능합니다.")
     sys.exit(1)
 else:
-    addepisode = conf['default_episode']
+    refresh_days = int(conf['default_refresh_days'])
+    refresh_from = (today + timedelta(days=2)).strftime('%Y%m%d')     # 오늘과 내일은 항상 새로 가져옴
+
+shard = None
+if args['shard']:
+    matches = re.match(r'^(\d+)/(\d+)$', args['shard'])
+    if not matches or not 1 <= int(matches.group(1)) <= int(matches.group(2)):
+        log.error('--shard는 i/N (1 <= i <= N) 형식이어야 합니다: %s', args['shard'])
+        sys.exit(1)
+    shard = (int(matches.group(1)), int(matches.group(2)))
+    # 같은 곳에서 여러 샤드를 돌려도 서로의 기록을 덮어쓰지 않게
+    suffix = '.shard-%s-of-%s' % shard
+    for key, default in [('deadfile', deadfile), ('journal', journalfile), ('store', storefile)]:
+        if args[key] == default:
+            root, ext = os.path.splitext(default)
+            args[key] = root + suffix + ext
+    log.info('샤드 %s/%s를 가져옵니다.', shard[0], shard[1])
+
+serve_address = None
+if args['serve']:
+    host, _, port = args['serve'].rpartition(':')
+    if not port.isdigit() or int(port) > 65535:
+        log.error('--serve는 [HOST:]PORT 형식이어야 합니다: %s', args['serve'])
+        sys.exit(1)
+    serve_address = (host or '127.0.0.1', int(port))
 
-if not any(conf['default_verbose'] in s for s in 'yn'):
-    log.error("default_verbose는 y, n만 가능합니다.")
-    sys.exit(1)
-else:
-    addverbose = conf['default_verbose']
+# 없는 채널 기록: 'Source|ServiceId' -> 정보
+DeadServices = {}
+if dead_days > 0 and os.path.exists(args['deadfile']):
+    try:
+        with open(args['deadfile'], 'rb') as f:
+            DeadServices = {'%s|%s' % (x['Source'], x['ServiceId']): x for x in json_loads(f.read())}
+    except Exception as e:
+        log.warning('없는 채널 기록을 읽지 못했습니다: %s: %s', args['deadfile'], str(e))
+
+for profile in profiles:
+    # --plan은 출력하지 않으므로 열지 않는다
+    profile['output'] = None if args['plan'] else open_output(profile)
+    if profile['output'] is None and not args['plan']:
+        for p in profiles:
+            if p.get('output') is not None:
+                p['output'].abort()
+        sys.exit(1)
 
-if not any(conf['default_xmltvns'] in s for s in 'yn'):
-    log.error("default_xmltvns는 y, n만 가능합니다.")
+# 가져온 EPG: 채널 Id별 채널 정보와 프로그램 목록
+EPGChannels = OrderedDict()
+EPGPrograms = {}
+WAVVEProgramCache = {}
+AliasOf = {}    # 같은 서비스를 가리키는 채널 Id -> 그 서비스를 가져오는 채널 Id
+
+try:
+    store = EPGStore(args['store'])
+except sqlite3.Error as e:
+    log.error('저장소 파일을 열 수 없습니다: %s: %s', args['store'], str(e))
     sys.exit(1)
-else:
-    addxmltvns = conf['default_xmltvns']
 
-if not any(conf['default_fetch_limit'] in s for s in '1234567'):
-    log.error("default_fetch_limit은 1-7만 가능합니다.")
+try:
+    journal = None if args['render'] or args['merge'] else Journal(args['journal'], args['resume'], readonly=args['plan'])
+except OSError as e:
+    log.error('작업 기록 파일을 열 수 없습니다: %s', str(e))
     sys.exit(1)
-else:
-    period = int(conf['default_fetch_limit'])
 
-getEpg()
+try:
+    if args['plan']:
+        planEpg()
+    elif args['merge']:
+        mergeEpg(args['merge'])
+    elif args['render']:
+        renderEpg()
+    else:
+        getEpg()
+    index = EPGIndex(store) if serve_address and not args['plan'] else None
+except BaseException:
+    for profile in profiles:
+        if profile['output'] is not None:
+            profile['output'].abort()
+    if journal is not None:
+        journal.close()
+    raise
+finally:
+    store.close()
+if journal is not None:
+    journal.close(remove=True)
+if index is not None:
+    serveEpg(index)
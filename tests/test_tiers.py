@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""epg2xml-sim.py 시뮬레이터로 epg2xml.py를 실행해서 채널 묶음(channel_tiers)과 요청 단위 재사용을 확인한다."""
+import os
+import re
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+import importlib.util
+from datetime import datetime, timedelta
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_sim():
+    spec = importlib.util.spec_from_file_location('epg2xml_sim', os.path.join(ROOT, 'epg2xml-sim.py'))
+    sim = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(sim)
+    return sim
+
+
+sim = load_sim()
+
+
+class TierTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        shutil.copy(os.path.join(ROOT, 'epg2xml.py'), self.workdir)
+        self.channels = sim.synthetic_channels(28)
+        self.server = sim.start_server(self.channels, programs=6)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.workdir)
+
+    def run_epg(self, channels, conf, *args):
+        path = lambda name: os.path.join(self.workdir, name)
+        with open(path('Channel.json'), 'w', encoding='utf-8') as f:
+            json.dump(channels, f, ensure_ascii=False)
+        with open(path('epg2xml.json'), 'w', encoding='utf-8') as f:
+            json.dump(dict({
+                'MyISP': 'ALL',
+                'MyChannels': '*',
+                'output': 'o',
+                'default_xml_file': path('xmltv.xml'),
+                'default_dead_days': '0',
+            }, **conf), f)
+        subprocess.check_call([sys.executable, path('epg2xml.py'), '--config', path('epg2xml.json'),
+                               '--channelfile', path('Channel.json'), '--logfile', path('epg2xml.py.log'),
+                               '--loglevel', 'WARNING', '--upstream', self.server.url] + list(args),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        days = defaultdict(set)
+        with open(path('xmltv.xml'), 'r', encoding='utf-8') as f:
+            for start, channel in re.findall(r'<programme start="(\d{8})\d* \+0900" stop="[^"]*" channel="([^"]*)">', f.read()):
+                days[channel].add(start)
+        return days
+
+    def assertDays(self, days, ids, count):
+        for ChannelId in ids:
+            self.assertEqual(len(days[str(ChannelId)]), count, 'channel %s' % ChannelId)
+
+    def test_bulk_sources_get_every_day_in_every_tier(self):
+        # 두 번째 묶음의 WAVVE/TVING 채널이 첫 번째 묶음이 남긴 요청 단위를 받아서 일수가 모자라면 안 된다
+        conf = {
+            'default_fetch_limit': '2',
+            'default_refresh_days': '3',
+            'default_wavve_daily': 'y',
+            'channel_tiers': [
+                {'MyChannels': '1-14', 'priority': '1', 'fetch_limit': '4'},
+                {'MyChannels': '*', 'priority': '2', 'fetch_limit': '4'},
+            ],
+        }
+        ids = [c['Id'] for c in self.channels]
+        self.assertDays(self.run_epg(self.channels, conf), ids, 4)
+        # 저장소의 요청 단위를 다시 사용해도 같아야 한다
+        self.assertDays(self.run_epg(self.channels, conf), ids, 4)
+
+    def assertReusedUnitsFollowChannelSet(self, source):
+        # 채널이 추가되면 저장소에 있는 그 전 채널 목록의 편성표를 다시 사용하면 안 된다
+        conf = {'default_fetch_limit': '4', 'default_refresh_days': '3', 'default_wavve_daily': 'y'}
+        added = [c for c in self.channels if c['Source'] == source][-1]
+        self.run_epg([c for c in self.channels if c is not added], conf)
+        self.assertDays(self.run_epg(self.channels, conf), [added['Id']], 4)
+
+    def test_reused_tving_units_follow_channel_set(self):
+        self.assertReusedUnitsFollowChannelSet('TVING')
+
+    def test_reused_wavve_units_follow_channel_set(self):
+        self.assertReusedUnitsFollowChannelSet('WAVVE')
+
+    def test_wavve_pages_survive_a_failed_first_page(self):
+        # 한 날의 첫 페이지가 실패해도 다른 날의 나머지 페이지는 가져오고 Channel_WAVVE.json은 그대로 둔다
+        channels = sim.synthetic_channels(140, sources=['WAVVE'])
+        conf = {'default_fetch_limit': '3', 'default_wavve_daily': 'y'}
+        self.server.upstream.services['WAVVE'] = [c['ServiceId'] for c in channels]
+        self.run_epg(channels, conf)
+        failed = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')
+        route = self.server.upstream.route
+
+        def failing_route(host, path, q):
+            if path == '/live/epgs' and q.get('offset') == '0' and q['startdatetime'].startswith(failed):
+                return None
+            return route(host, path, q)
+
+        self.server.upstream.route = failing_route
+        days = self.run_epg(channels, conf)
+        self.assertDays(days, [c['Id'] for c in channels[100:]], 3)
+        self.assertDays(days, [c['Id'] for c in channels[:100]], 2)
+        with open(os.path.join(self.workdir, 'Channel_WAVVE.json'), 'r', encoding='utf-8') as f:
+            self.assertEqual(json.load(f)[0]['total'], 140)
+
+
+if __name__ == '__main__':
+    unittest.main()